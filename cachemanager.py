@@ -0,0 +1,91 @@
+import os
+import re
+import time
+
+from MPG.headerpack import HeaderPack, PACK_EXT, INDEX_EXT
+from MPG.keywordcache import CACHE_EXT
+
+# Disk budget for the downloaded data of the nightlogs/<tel>/P<period>/<night>
+# tree.  Only data that can be fetched again from the archive is evicted:
+# the night listings (.xml), header packs, legacy .fits.hdr files and the
+# keyword caches.  The logs themselves are kept.  Nights of the current
+# period are pinned.  Eviction is by least recent use (pack access times,
+# see touch) or by night age.
+
+def is_cache_file(night, filename):
+    if filename.endswith('.fits.hdr'):
+        return True
+    return filename in [night + '.xml', night + PACK_EXT, night + INDEX_EXT,
+                        night + CACHE_EXT]
+
+def touch(path):
+    # Record use of a night's cached data (for LRU eviction)
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+class NightCache:
+    def __init__(self, path, period):
+        self.path = path
+        self.period = period
+        self.night = os.path.basename(path)
+        self.files = [os.path.join(path, f) for f in os.listdir(path)
+                        if is_cache_file(self.night, f)]
+        stats = [os.stat(f) for f in self.files]
+        self.size = sum(s.st_size for s in stats)
+        self.last_used = os.stat(path).st_mtime
+        if len(stats):
+            self.last_used = max(self.last_used,
+                    *[s.st_mtime for s in stats])
+    def evict(self):
+        for filename in self.files:
+            if filename.endswith(PACK_EXT):
+                HeaderPack.open(filename).forget()
+            os.remove(filename)
+        self.files = []
+        self.size = 0
+
+class CacheManager:
+    def __init__(self, path, tel, budget, policy='lru', pinned=None):
+        # budget in bytes, pinned: list of pinned periods
+        self.root = os.path.join(path, tel)
+        self.budget = budget
+        self.policy = policy
+        self.pinned = set(pinned or [])
+    def scan(self):
+        nights = []
+        for pdir in sorted(os.listdir(self.root)):
+            m = re.match('^P([0-9]+)$', pdir)
+            if m is None:
+                continue
+            period = int(m.group(1))
+            ppath = os.path.join(self.root, pdir)
+            for ndir in sorted(os.listdir(ppath)):
+                npath = os.path.join(ppath, ndir)
+                if (re.match('^[0-9]{4}-[0-9]{2}-[0-9]{2}$', ndir) and
+                        os.path.isdir(npath)):
+                    nights.append(NightCache(npath, period))
+        return nights
+    def usage(self):
+        return sum(n.size for n in self.scan())
+    def enforce(self, verbose=1):
+        nights = self.scan()
+        total = sum(n.size for n in nights)
+        candidates = [n for n in nights
+                        if n.period not in self.pinned and n.size > 0]
+        if self.policy == 'age':
+            candidates.sort(key=lambda n: n.night)
+        else:
+            candidates.sort(key=lambda n: n.last_used)
+        evicted = []
+        for night in candidates:
+            if total <= self.budget:
+                break
+            total -= night.size
+            night.evict()
+            evicted.append(night.night)
+        if verbose > 0:
+            print('cache: {:.1f} MB used, {} nights evicted'.format(
+                        total / 1e6, len(evicted)))
+        return evicted
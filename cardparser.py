@@ -0,0 +1,139 @@
+import re
+import time
+import numpy
+
+# Lean reader for the FITS header cards listed in esolog.dat.  Instead of
+# building a full astropy Header, the raw text (80-column cards, as stored
+# in the night header pack) is scanned once and only the values of the
+# requested keywords are decoded.  Lookup follows astropy's rules: keys
+# are case insensitive, the HIERARCH prefix is optional and the first
+# occurrence of a keyword wins.
+
+def normalise_key(key):
+    key = ' '.join(key.split()).upper()
+    if key[0:9] == 'HIERARCH ':
+        key = key[9:]
+    return key
+
+def parse_value(s):
+    s = s.lstrip()
+    if s[0:1] == "'":
+        # string: '' is an escaped quote, trailing blanks are not significant
+        m = re.match("'((?:[^']|'')*)'", s)
+        if m is None:
+            return s[1:].rstrip()
+        return m.group(1).replace("''", "'").rstrip()
+    s = s.split('/', 1)[0].strip()
+    if s == '':
+        return None
+    if s == 'T':
+        return True
+    if s == 'F':
+        return False
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s.replace('D', 'E'))
+    except ValueError:
+        return s
+
+class CardParser:
+    def __init__(self, keywords):
+        self.names = keywords['name'].tolist()
+        self.types = keywords['type'].tolist()
+        self.widths = keywords['width'].tolist()
+        self.defaults = [numpy.dtype(t).type(d)
+                    for t, d in zip(self.types, keywords['default'])]
+        self.fits_keys = []
+        for keys in keywords['fits_keys']:
+            keys = [k.strip() for k in keys.split(',')]
+            if '--' in keys:
+                keys = keys[0:keys.index('--')]
+            self.fits_keys.append([normalise_key(k) for k in keys if k])
+        self.wanted = set(k for keys in self.fits_keys for k in keys)
+    def scan(self, text):
+        # Return {key: value} for the wanted cards in the header text
+        values = {}
+        if '\n' in text:
+            cards = text.splitlines()
+        else:
+            cards = (text[i:i+80] for i in range(0, len(text), 80))
+        for card in cards:
+            if card[0:8] == 'HIERARCH':
+                eq = card.find('=')
+                if eq < 0:
+                    continue
+                key = normalise_key(card[0:eq])
+                value = card[eq+1:]
+            elif card[8:10] == '= ':
+                key = card[0:8].rstrip().upper()
+                value = card[10:]
+            elif card[0:8].rstrip() == 'END':
+                break
+            else:
+                continue
+            if key in self.wanted and key not in values:
+                value = parse_value(value)
+                if value is not None:
+                    values[key] = value
+        return values
+    def load_keywords(self, text):
+        # Same row as BasicLog.load_keywords(Header.fromstring(text))
+        values = self.scan(text)
+        row = []
+        for keys, dflt, width in zip(self.fits_keys, self.defaults,
+                                     self.widths):
+            value = dflt
+            for key in keys:
+                if key in values:
+                    value = values[key]
+                    break
+            if isinstance(value, (bytes, str)):
+                value = value.ljust(width)
+            row.append(value)
+        return row
+    def load_rows(self, texts):
+        return [self.load_keywords(t) for t in texts]
+    def load_columns(self, texts):
+        rows = self.load_rows(texts)
+        cols = zip(*rows) if len(rows) else [[] for t in self.types]
+        return [numpy.array(c, dtype=t) for c, t in zip(cols, self.types)]
+
+def benchmark(texts, repeat=3):
+    # Compare with the astropy path of BasicLog.load_keywords
+    from astropy.io import fits as pyfits
+    from MPG.esolog import BasicLog
+    parser = CardParser(BasicLog.keywords)
+    ref = [BasicLog.load_keywords(pyfits.Header.fromstring(t)) for t in texts]
+    new = parser.load_rows(texts)
+    nbad = sum(r != n for r, n in zip(ref, new))
+    timings = []
+    for fun in [lambda: [BasicLog.load_keywords(pyfits.Header.fromstring(t))
+                            for t in texts],
+                lambda: parser.load_rows(texts)]:
+        best = None
+        for i in range(repeat):
+            t0 = time.time()
+            fun()
+            dt = time.time() - t0
+            best = dt if best is None or dt < best else best
+        timings.append(best)
+    n = len(texts)
+    t1, t2 = timings
+    print('{} headers, {} rows differ'.format(n, nbad))
+    print('Header.fromstring: {:.3f} s ({:.0f} headers/s)'.format(t1, n / t1))
+    print('CardParser:        {:.3f} s ({:.0f} headers/s)'.format(t2, n / t2))
+    print('speed-up:          {:.1f}x'.format(t1 / t2))
+    return timings
+
+if __name__ == "__main__":
+    # python3 -m MPG.cardparser <night>-headers.pack [...]
+    import sys
+    from MPG.headerpack import HeaderPack
+    texts = []
+    for filename in sys.argv[1:]:
+        pack = HeaderPack(filename)
+        texts += [pack.get(d) for d in pack.keys()]
+    benchmark(texts)
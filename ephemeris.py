@@ -0,0 +1,181 @@
+import os
+import copy
+import json
+import datetime
+import threading
+import ephem
+from math import pi
+
+from MPG.utils import iter_period_dates
+
+# Sun and moon events of the nights of an ESO period at a telescope:
+# night (sun below -18 deg), astronomical twilight (-12 deg), sun down
+# (-2 deg), dark time (night without the moon) and fraction of lunar
+# illumination.  They are computed once for the whole period, kept in
+# memory and stored as nightlogs/<tel>/P<period>/P<period>-ephemeris.json,
+# and shared by NightLog, PeriodLog and the schedule.
+
+SITES = {
+    '2.2m': (-70.7346, -29.2543, 2350),
+    '3.6m': (-70.7346, -29.2543, 2350),
+    'NTT': (-70.7346, -29.2543, 2350),
+}
+
+def get_site(tel):
+    if tel not in SITES:
+        raise RuntimeError('Unimplemented telescope')
+    return SITES[tel]
+
+def isoformat(d):
+    return d.isoformat()[0:19]
+
+def night_ephemeris(night, lon, lat, alt, obs=None):
+    # Events for the night starting on date night (YYYY-MM-DD)
+    sun = ephem.Sun()
+    moon = ephem.Moon()
+    if obs is None:
+        obs = ephem.Observer()
+    obs.date = datetime.datetime.strptime(str(night)[0:10], '%Y-%m-%d')
+    obs.date += 1 - lon / 360
+    obs.lon = lon * pi / 180
+    obs.lat = lat * pi / 180
+    obs.elev = alt
+    obs.pressure = 0
+    obs.temp = 0
+    # obs may be reused from the previous night
+    obs.horizon = '0'
+    sun.compute(obs)
+    moon.compute(obs)
+    eph = {}
+    # Night
+    obs.horizon = '-18:00'
+    ne, ns = [isoformat(f(sun, use_center=True).datetime())
+                 for f in [obs.next_rising, obs.previous_setting]]
+    eph['night_hours'] = [(ns, ne)]
+    # Astronomical twilight
+    obs.horizon = '-12:00'
+    te, ts = [isoformat(f(sun, use_center=True).datetime())
+                 for f in [obs.next_rising, obs.previous_setting]]
+    eph['twilight_hours'] = [(ts, ns), (ne, te)]
+    # Sunrise/Sunset
+    obs.horizon = '-2:00'
+    sr, ss = [isoformat(f(sun, use_center=False).datetime())
+                 for f in [obs.next_rising, obs.previous_setting]]
+    eph['sundown_hours'] =  [(ss, sr)]
+    # Moon
+    eph['fli'] = moon.moon_phase
+    dark = []
+    if moon.neverup:
+        dark = [(ns, ne)]
+    elif not moon.circumpolar:
+        obs.date = datetime.datetime.strptime(ns, '%Y-%m-%dT%H:%M:%S')
+        mr, ms = [isoformat(f(moon, use_center=False).datetime())
+                 for f in [obs.next_rising, obs.next_setting]]
+        eph['moon_rise'] = mr
+        eph['moon_set'] = ms
+        if ms < mr:
+            ds, de = min(ms, ne), min(mr, ne)
+            if ds < de:
+                dark = [(ds, de)]
+        else:
+            ds1, de1 = ns, min(mr, ne)
+            if ds1 < de1:
+                dark = [(ds1, de1)]
+            ds2, de2 = min(ms, ne), min(mr, ne)
+            if ds2 < de2:
+                dark.append((ds2, de2))
+    eph['dark_hours'] = dark
+    return eph
+
+def as_tuples(eph):
+    # Intervals back from JSON lists
+    return {k: [tuple(i) for i in v] if k[-6:] == '_hours' else v
+                for k, v in eph.items()}
+
+class PeriodEphemeris:
+    _tables = {}
+    _lock = threading.Lock()
+    @classmethod
+    def get(cls, tel, period, path=None):
+        # Shared table, read from path if stored there, else computed
+        # (and stored when a path is given)
+        if path is not None:
+            path = os.path.abspath(path)
+        key = (tel, int(period), path)
+        with cls._lock:
+            if key not in cls._tables:
+                table = cls(tel, period, path=path)
+                if not table.load():
+                    table.compute()
+                    table.save()
+                cls._tables[key] = table
+            return cls._tables[key]
+    def __init__(self, tel, period, path=None):
+        self.tel = tel
+        self.period = int(period)
+        self.filename = None
+        if path is not None:
+            pdir = 'P{}'.format(self.period)
+            self.filename = os.path.join(path, tel, pdir,
+                    '{}-ephemeris.json'.format(pdir))
+        self.nights = {}
+    def compute(self):
+        lon, lat, alt = get_site(self.tel)
+        obs = ephem.Observer()
+        self.nights = {str(d): night_ephemeris(d, lon, lat, alt, obs=obs)
+                            for d in iter_period_dates(self.period)}
+    def load(self):
+        if self.filename is None:
+            return False
+        try:
+            with open(self.filename, 'r') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if data.get('site') != list(get_site(self.tel)):
+            return False
+        self.nights = {n: as_tuples(e) for n, e in data['nights'].items()}
+        return True
+    def save(self):
+        if self.filename is None:
+            return
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        data = {'tel': self.tel, 'period': self.period,
+                'site': list(get_site(self.tel)), 'nights': self.nights}
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            json.dump(data, fh, indent=1)
+        os.replace(tmpname, self.filename)
+    def __getitem__(self, night):
+        return self.nights[str(night)[0:10]]
+    def __contains__(self, night):
+        return str(night)[0:10] in self.nights
+    def intervals(self, name, nights=None):
+        # Concatenated intervals (e.g. 'dark_hours') of the nights
+        if nights is None:
+            nights = sorted(self.nights)
+        return [i for n in nights for i in self[n][name]]
+    def sun_events(self, nights=None):
+        # (sunset, end of evening twilight, start of morning twilight,
+        # sunrise) as datetimes
+        if nights is None:
+            nights = sorted(self.nights)
+        events = []
+        for n in nights:
+            (ss, sr), = self[n]['sundown_hours']
+            (ns, ne), = self[n]['night_hours']
+            events.append(tuple(datetime.datetime.strptime(d,
+                '%Y-%m-%dT%H:%M:%S') for d in [ss, ns, ne, sr]))
+        return events
+
+def night_period(night):
+    # ESO period of a night (every 6 months starting Oct. 1st and Apr. 1st)
+    year, month = int(str(night)[0:4]), int(str(night)[5:7])
+    return 94 + 2 * (year - 2015) + (month > 3) + (month > 9)
+
+def get_night_ephemeris(tel, night, path=None):
+    table = PeriodEphemeris.get(tel, night_period(night), path=path)
+    if night in table:
+        return copy.deepcopy(table[night])
+    lon, lat, alt = get_site(tel)
+    return night_ephemeris(night, lon, lat, alt)
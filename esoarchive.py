@@ -1,5 +1,296 @@
+import io
+import time
+import gzip
+import random
+import threading
+import http.client
+import xml.etree.ElementTree as ElementTree
 import urllib
+import urllib.error
+import urllib.parse
 import urllib.request
+from math import nan
+
+# HTTP statuses meaning the archive is busy: back off and retry
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+class RateLimiter:
+    # Client-side throttling of archive requests.
+    #
+    # A token bucket caps the request rate and an AIMD window bounds the
+    # number of requests in flight: the window grows additively while
+    # requests succeed and shrinks multiplicatively when the archive
+    # throttles or times out (once per window: requests issued before a
+    # decrease do not trigger another one).
+    # Retries wait for a jittered exponential backoff and draw on a retry
+    # budget replenished by successful requests, so that a failing archive
+    # is not hammered.
+    def __init__(self, rate=100., burst=20, concurrency=4,
+            max_concurrency=32, backoff=0.5, max_backoff=60.,
+            max_attempts=8, retry_budget=20., retry_ratio=0.5,
+            decrease=0.7):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.inflight = 0
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.budget = retry_budget
+        self.max_budget = retry_budget
+        self.retry_ratio = retry_ratio
+        self.decrease = decrease
+        self.epoch = 0
+        self.stamp = time.time()
+        self.cond = threading.Condition()
+        self.counters = {'requests': 0, 'successes': 0, 'retries': 0,
+            'throttled': 0, 'failures': 0, 'wait_time': 0.}
+    def share(self, n):
+        # Limiter with 1/n of the rate, window and retry budget, for one
+        # of n processes that together keep to the limits of this one.  
+        # Each adapts its own window (AIMD) within its share.
+        return RateLimiter(rate=self.rate / n, 
+                burst=max(1, self.burst // n),
+                concurrency=max(1, self.concurrency // n),
+                max_concurrency=max(1, self.max_concurrency // n),
+                backoff=self.backoff, max_backoff=self.max_backoff,
+                max_attempts=self.max_attempts, 
+                retry_budget=self.max_budget / n,
+                retry_ratio=self.retry_ratio, decrease=self.decrease)
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+    def acquire(self):
+        t0 = time.time()
+        with self.cond:
+            while True:
+                self._refill()
+                if self.inflight < int(self.concurrency) and self.tokens >= 1:
+                    break
+                if self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate
+                else:
+                    timeout = None
+                self.cond.wait(timeout)
+            self.tokens -= 1
+            self.inflight += 1
+            self.counters['requests'] += 1
+            self.counters['wait_time'] += time.time() - t0
+            return self.epoch
+    def release(self, epoch, ok=True, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.counters['throttled'] += 1
+                if epoch == self.epoch:
+                    self.epoch += 1
+                    self.concurrency = max(1.,
+                            self.concurrency * self.decrease)
+            elif ok:
+                self.counters['successes'] += 1
+                self.concurrency = min(self.max_concurrency,
+                        self.concurrency + 1 / self.concurrency)
+                self.budget = min(self.max_budget,
+                        self.budget + self.retry_ratio)
+            self.cond.notify_all()
+    def may_retry(self, attempt):
+        with self.cond:
+            if attempt + 1 >= self.max_attempts or self.budget < 1:
+                self.counters['failures'] += 1
+                return False
+            self.budget -= 1
+            self.counters['retries'] += 1
+            return True
+    def wait(self, attempt, delay=None):
+        # Full jitter exponential backoff, or server's Retry-After
+        if delay is None:
+            cap = min(self.max_backoff, self.backoff * 2 ** attempt)
+            delay = random.uniform(0, cap)
+        time.sleep(delay)
+        with self.cond:
+            self.counters['wait_time'] += delay
+    def get_counters(self):
+        with self.cond:
+            counters = dict(self.counters)
+            counters['concurrency'] = self.concurrency
+            return counters
+
+def is_throttled(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in RETRY_STATUSES
+    # connection timeouts (errno 110) and resets
+    return isinstance(error, urllib.error.URLError)
+
+def retry_after(error):
+    if not isinstance(error, urllib.error.HTTPError):
+        return None
+    try:
+        return float(error.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+class ArchiveClient:
+    # HTTP client keeping a pool of keep-alive connections per host, so
+    # that thousands of header requests reuse a few TCP/TLS sessions.
+    # Requests go through a RateLimiter and are retried when throttled.
+    def __init__(self, timeout=60, maxsize=16, max_redirects=5,
+            limiter=None):
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.max_redirects = max_redirects
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.pools = {}
+        self.lock = threading.Lock()
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+    def _acquire(self, key):
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool):
+                return pool.pop(), True
+        return self._connect(*key), False
+    def _release(self, key, conn):
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.maxsize:
+                pool.append(conn)
+                return
+        conn.close()
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                for conn in pool:
+                    conn.close()
+            self.pools = {}
+    def _request(self, method, url, body, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive',
+                   **headers}
+        if body is not None:
+            headers.setdefault('Content-Type',
+                    'application/x-www-form-urlencoded')
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                # The server may have dropped an idle keep-alive connection
+                if reused:
+                    continue
+                error = urllib.error.URLError(e)
+                error.errno = getattr(e, 'errno', None)
+                raise error
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+        return response, data
+    def request(self, method, url, body=None, headers={}):
+        attempt = 0
+        while True:
+            epoch = self.limiter.acquire()
+            try:
+                data = self._follow(method, url, body, headers)
+            except urllib.error.URLError as error:
+                throttled = is_throttled(error)
+                self.limiter.release(epoch, ok=False, throttled=throttled)
+                if not throttled or not self.limiter.may_retry(attempt):
+                    raise error
+                self.limiter.wait(attempt, retry_after(error))
+                attempt += 1
+                continue
+            self.limiter.release(epoch, ok=True)
+            return data
+    def _follow(self, method, url, body, headers):
+        for i in range(self.max_redirects + 1):
+            response, data = self._request(method, url, body, headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status,
+                        response.reason, response.msg, io.BytesIO(data))
+            return data
+        raise urllib.error.URLError('too many redirections: ' + url)
+    def get(self, url):
+        return self.request('GET', url)
+    def post(self, url, data):
+        return self.request('POST', url, body=data)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # Client shared by all archive (and schedule) requests
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ArchiveClient()
+        return _client
+
+def share_client(n):
+    # Client of one of n worker processes, with 1/n of the default limits
+    global _client
+    with _client_lock:
+        _client = ArchiveClient(limiter=RateLimiter().share(n))
+        return _client
+
+def iter_votable_rows(filename, names=('dp_id',)):
+    # Stream the rows of a TABLEDATA VOTable, yielding the values of the
+    # given columns.  Parsed rows are dropped as we go, so that memory
+    # stays flat whatever the number of frames.
+    fields = []
+    index = None
+    tabledata = None
+    types = [to_float if n == 'exptime' else str for n in names]
+    for event, elem in ElementTree.iterparse(filename, events=('start', 'end')):
+        tag = elem.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag == 'TABLEDATA':
+                tabledata = elem
+            elif tag in ['BINARY', 'BINARY2', 'FITS']:
+                yield from _iter_votable_rows_astropy(filename, names)
+                return
+        elif tag == 'FIELD':
+            fields.append(elem.get('name'))
+        elif tag == 'TR':
+            if index is None:
+                index = [fields.index(n) for n in names]
+            row = [td.text or '' for td in elem]
+            yield tuple(t(row[i]) for i, t in zip(index, types))
+            tabledata.clear()
+
+def to_float(s):
+    # Empty cells are missing values
+    return float(s) if s else nan
+
+def _iter_votable_rows_astropy(filename, names):
+    from astropy.io.votable import parse_single_table
+    table = parse_single_table(filename, pedantic=False)
+    cols = [table.array[n] for n in names]
+    cols = [c.filled(nan) if c.dtype.kind == 'f' else c.filled('') 
+                for c in cols]
+    for row in zip(*cols):
+        yield tuple(v.decode() if isinstance(v, bytes) else v for v in row)
 
 class NightRequest:
     def __init__(self, night, inslist, output='html',
@@ -14,14 +305,8 @@ class NightRequest:
         })
     def url(self):
        return self.baseurl + '?' + self.form
+    def fetch(self, encode='utf-8'):
+        form = self.form.encode(encode)
+        return get_client().post(self.baseurl, form)
     def urlopen(self, encode='utf-8'):
-        form = self.form.encode(encode) 
-        ok = False
-        while not ok:
-           try:
-                result = urllib.request.urlopen(self.baseurl, form)
-                ok = True
-           except urllib.error.URLError as error:
-                if error.errno != 110:
-                     raise error
-        return result
+        return io.BytesIO(self.fetch(encode=encode))
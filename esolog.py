@@ -6,21 +6,37 @@ import sys
 sys.path.append('/home/lachaume/Dropbox/python/')
 
 from MPG.utils import structured_array_from_excel
-from MPG.esoarchive import NightRequest
+from MPG.esoarchive import NightRequest, get_client, iter_votable_rows
+from MPG.esoarchive import share_client
+from MPG.headerpack import HeaderPack, PACK_EXT
+from MPG.headerpack import format_header_text, read_header_textfile
+from MPG.keywordcache import KeywordCache, keyword_table_hash, CACHE_EXT
+from MPG.cardparser import CardParser
+from MPG.cachemanager import CacheManager, touch
+from MPG.intervals import IntervalSet
+from MPG.reducers import Segments, reduce
+from MPG.timing import profiler, span
+from MPG.ephemeris import PeriodEphemeris, get_night_ephemeris
+from MPG.ephemeris import night_ephemeris, night_period
 
 import numpy
 import re
 import urllib.request, urllib.parse
 import os, re, sys, time, warnings, iso8601, datetime, ephem
 from numpy import sqrt, hstack, arange, array, unique, pi
-from astropy.io.votable import parse_single_table
 from astropy.io import fits as pyfits
+import astropy.table
+import hashlib
 from copy import copy, deepcopy
 import asciitable
 import io
 import pylab
 from MPG.gtable import Table, Column, TableGroups
 import itertools
+import json
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 warnings.filterwarnings('ignore') 
 
@@ -64,8 +80,8 @@ def date_to_night(date, lon):
     # Converts to mean solar time, 12 hours before
     # It always fall on the day before the night starts
     seconds = (lon / 360. - 0.5) * 86400
-    night = add_overhead(date, seconds=seconds)
-    return numpy.array([n[0:10] for n in night])
+    night = to_datetime64(date) + to_timedelta64(seconds)
+    return numpy.datetime_as_string(night, unit='D')
 
 def format_night_str(year=None, month=None, day=None):
   # ESO archive unexpectedly expects night to have dd mm yyyy format.
@@ -88,16 +104,47 @@ def parse_date(s):
         return numpy.array([parse_date(x) for x in s])
     return iso8601.parse_date(str(s))
 
+def to_datetime64(s):
+    # Vectorised parsing of ISO dates (or datetimes) to datetime64[us].
+    # Unparsable values (DUMMY, N/A) give NaT.
+    arr = numpy.asarray(s)
+    if arr.dtype.kind == 'M':
+        return arr.astype('datetime64[us]')
+    if arr.dtype.kind == 'O':
+        arr = numpy.array([str(x) for x in arr.flat]).reshape(arr.shape)
+    arr = numpy.char.strip(arr.astype(str))
+    try:
+        return arr.astype('datetime64[us]')
+    except ValueError:
+        return numpy.array([_to_datetime64(x) for x in arr.flat],
+                    dtype='datetime64[us]').reshape(arr.shape)
+
+def _to_datetime64(s):
+    try:
+        return numpy.datetime64(s, 'us')
+    except ValueError:
+        return numpy.datetime64('NaT', 'us')
+
+def to_timedelta64(seconds):
+    us = numpy.round(numpy.asarray(seconds, dtype=float) * 1e6)
+    return us.astype('int64').astype('timedelta64[us]')
+
 def isoformat(s):
+    if numpy.asarray(s).dtype.kind == 'M':
+        iso = numpy.datetime_as_string(s, unit='s')
+        return iso if numpy.ndim(iso) else str(iso)
     if numpy.ndim(s):
         return numpy.array([isoformat(x) for x in s])
     return s.isoformat()[0:19]
 
+def to_hours(dt):
+    return dt / numpy.timedelta64(3600, 's')
+
 def time_delta(a, b):
-    dt = parse_date(b) - parse_date(a)
+    dt = to_hours(to_datetime64(b) - to_datetime64(a))
     if numpy.ndim(dt):
-        return numpy.array([x.total_seconds() / 3600. for x in dt])
-    return dt.total_seconds() / 3600.
+        return dt
+    return float(dt)
 
 def daterange(a, b):
      numpy.hstack([numpy.arange(a, b), b])
@@ -145,11 +192,31 @@ def max(a, b):
     return c1
 
 def add_overhead(strdate, seconds=0):
-    if numpy.ndim(strdate) == 0 and numpy.ndim(seconds) == 0:
-        newdate = parse_date(strdate) + datetime.timedelta(seconds=seconds)
-        return isoformat(newdate)
-    date, sec = numpy.broadcast_arrays(strdate, seconds)
-    return numpy.array([add_overhead(d, s) for d, s in zip(date, sec)]) 
+    return isoformat(to_datetime64(strdate) + to_timedelta64(seconds))
+
+def sorted_segments(key):
+    # Stable sort order of key and index of the first row of each run of
+    # equal values in the sorted key (for reduceat)
+    order = numpy.argsort(key, kind='stable')
+    key = array(key)[order]
+    first = numpy.ones(len(key), dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    return order, numpy.flatnonzero(first)
+
+def segment_lengths(first, n):
+    return numpy.diff(numpy.append(first, n))
+
+def fill_backward(values, copy):
+    # values[i] replaced by the value of the first row j >= i for which
+    # copy[j] is False (copy[-1] must be False)
+    index = numpy.where(copy, len(copy), numpy.arange(len(copy)))
+    index = numpy.minimum.accumulate(index[::-1])[::-1]
+    return values[index]
+
+def is_recent_night(night, days=3):
+    # Nights whose archive listing may still change, regenerated with
+    # clobberLastNights
+    return (datetime.date.today() - parse_date(night).date()).days < days
 
 def report(verbose, string, *arg, **kwarg):
     if verbose > 0:
@@ -166,6 +233,27 @@ class BasicLog(Table):
     }
     keywords = Table.read('/home/lachaume/Dropbox/bin/esolog.dat',
         format='ascii.fixed_width_two_line')
+    # Reduction of columns when binning (see MPG.reducers and get_reducer)
+    reducers = {
+        'start': ('min',), 'seeing_start': ('min',), 'airmass_start': ('min',),
+        'end': ('max',), 'seeing_end': ('max',), 'airmass_end': ('max',),
+        'ob_start': ('unique', 'N/A'), 'ob_end': ('unique', 'N/A'),
+        'tpl_start': ('unique', 'N/A'), 'tpl_end': ('unique', 'N/A'),
+        'ob_name': ('unique', 'N/A'),
+        'obs_cat': ('majority', ['SCIENCE', 'CALIB']),
+        'tplno': ('unique', -1), 'expno': ('unique', -1),
+        'internal': ('min',),
+    }
+    # Per-night time accounting (see rollup)
+    rollup_keys = ['tac', 'tac_pid', 'ins', 'obs_cat']
+    rollup_times = ['time', 'night_time', 'twilight_time', 'dark_time', 
+                    'exptime']
+    # Columns with sorted indexes for query (see gtable.SortedIndex), 
+    # other columns are queried with a mask
+    indexed = ['night']
+    # Columns that may be dictionary-encoded (see encode_categories)
+    categorical = ['ins', 'obs_cat', 'obs_type', 'track', 'tac', 'pid',
+                   'target', 'filter']
     def __init__(self, *arg, names=None, tel=None, 
                         period=None, night=None, path='.', 
                         mirror='http://archive.eso.org', meta=None, **kwarg):
@@ -177,7 +265,12 @@ class BasicLog(Table):
         self._copy_indices = True
         self._init_indices = True
         if 'copy' not in kwarg or kwarg['copy'] is True:
-            kwarg['dtype'] = types
+            # Encoded columns keep their integer codes
+            source = meta if meta is not None else getattr(
+                        arg[0] if len(arg) else None, 'meta', {})
+            encoded = source.get('categories', {})
+            kwarg['dtype'] = ['int32' if n in encoded else t 
+                                for n, t in zip(names, types)]
             kwarg['names'] = names
         super().__init__(*arg, **kwarg)
         # if _meta is given, don't do initialisations.
@@ -206,10 +299,7 @@ class BasicLog(Table):
         # Determine ESO period (every 6 months starting Oct. 1st and Apr. 1st
         if numpy.ndim(night) == 1:
             return [night_to_period(n) for n in night]
-        night = str(night)
-        year, month, day = int(night[0:4]), int(night[5:7]), int(night[8:10])
-        period = 94 + 2 * (year - 2015) + (month > 3) + (month > 9)
-        return period
+        return night_period(night)
     @classmethod
     def get_defaults(cls):
         defaults = cls.keywords.default
@@ -220,42 +310,67 @@ class BasicLog(Table):
         defaults = [array(d, dtype=t) 
                 for d, t, w in zip(defaults, types, widths)]
         return tuple(defaults)
-    def get_header(self, dataid, verbose=1, clobber=False):
-        dataid = dataid.decode()
+    def get_header_pack(self):
+        return HeaderPack.open(self.get_path(fileext=PACK_EXT))
+    def get_header(self, dataid, verbose=1, clobber=False, raw=False):
+        if isinstance(dataid, bytes):
+            dataid = dataid.decode()
         path = self.get_path()
         mirror = self.mirror
         if verbose <= 0:
             warnings.filterwarnings('ignore')
+        pack = self.get_header_pack()
         filename = os.path.join(path, dataid) + '.fits.hdr'
         report(verbose, 'Get header for {}', dataid)
+        h = None
         if not clobber:
-            try:
-                header = pyfits.Header.fromtextfile(filename)
-            except:
-                clobber = True
-        if clobber:
-            url = mirror + '/hdr?DpId=' + dataid
-            report(verbose, 'Download header ' + filename)
-            ok = False
-            while not ok:
+            h = pack.get(dataid)
+            # Legacy one-file-per-frame cache, moved to the pack
+            if h is None and os.path.exists(filename):
                 try:
-                     with urllib.request.urlopen(url) as response:
-                          page = response.read().decode('utf-8')
-                     ok = True
-                except urllib.request.URLError as error:
-                     if error.errno != 110:
-                         raise error
+                    h = read_header_textfile(filename)
+                    pack.append(dataid, h)
+                except:
+                    h = None
+        if h is None:
+            url = mirror + '/hdr?DpId=' + dataid
+            report(verbose, 'Download header ' + dataid)
+            page = get_client().get(url).decode('utf-8')
             h = re.search('<pre>(.*)</pre>', page, flags=re.S).groups()[0]
-            h = ''.join(l[0:80] + ' ' * (80 - len(l[0:80])) for l in h.splitlines())
-            h += ' ' * (2880 - (len(h) % 2880))
-            header = pyfits.Header.fromstring(h)
+            h = format_header_text(h.splitlines())
             mkdir(path)
-            try:
-                header.toTxtFile(filename, clobber=True)
-            except:
-                header.totextfile(filename, clobber=True)
+            pack.append(dataid, h)
+        if raw:
+            return h
+        header = pyfits.Header.fromstring(h)
         return header
-    def get_night_list(self, verbose=1, clobber=False):
+    def get_headers(self, datalist, jobs=1, verbose=1, clobber=False,
+            raw=False):
+        # Headers are independent HTTP round-trips, fetch them in a
+        # bounded thread pool.  Order of datalist is preserved.
+        def fetch(dataid):
+            return self.get_header(dataid, clobber=clobber, verbose=verbose,
+                        raw=raw)
+        t0 = time.time()
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                headers = list(pool.map(fetch, datalist))
+        else:
+            headers = [fetch(dataid) for dataid in datalist]
+        # Clobbered headers leave their former copy in the pack
+        if clobber and len(headers):
+            self.get_header_pack().compact()
+        dt = time.time() - t0
+        rate = len(headers) / dt if dt > 0 else 0.
+        report(verbose, 'Fetched {} headers in {:.1f} s ({:.1f} headers/s, '
+                '{} jobs)', len(headers), dt, rate, jobs)
+        counters = get_client().limiter.get_counters()
+        report(verbose, 'Archive requests: {requests}, retries: {retries}, '
+                'throttled: {throttled}, wait: {wait_time:.1f} s', **counters)
+        return headers
+    def iter_night_list(self, verbose=1, clobber=False, names=('dp_id',)):
+        # Stream rows of the archive listing of the night, so that header
+        # fetching can start while the XML is still being parsed. 
         mirror = self.mirror
         if verbose <= 0:
             warnings.filterwarnings('ignore')
@@ -263,52 +378,63 @@ class BasicLog(Table):
         instruments = self.instruments[tel]
         # Date
         night, isodate = format_night_str(self.get_night())
-        tel = self.telescope
         filepath = self.get_path()
         filename = self.get_path(fileext='xml')
-        # filename = os.path.join(path, isodate + '.xml')
         report(verbose, 'Get night log {}', filename)
-        #
-        # Try to read the file
-        #
-        if not clobber:
-            try:
-                table = parse_single_table(filename, pedantic=False)
-            except:
-                clobber = True
         # 
-        # Get the ESO archive
+        # Get the ESO archive, written to a temporary file first so that
+        # an interrupted download never replaces the listing
         #
-        if clobber:
-            url = mirror + '/wdb/wdb/eso/eso_archive_main/query'
-            # instrument query 
+        def fetch():
             request = NightRequest(night, inslist=instruments,  
+                    mirror=mirror,
                     output='votable/display', tab_exptime='on',
                     tab_instrument='on', tab_dp_id='on')
-            #inslist = ["(ins_id like '{0}%')".format(i) for i in instruments]
-            #insquery = '(' + ' or '.join(inslist)  + ')'
-            # form & query
-            #form = urllib.parse.urlencode({
-            #    'night': night, 'add': insquery,
-            #    'tab_dp_id': 'on', 'wdbo': 'votable/display',
-            #    'max_rows_returned': 999999,
-            #    'tab_exptime': 'on', 'tab_instrument': 'on',
-            #})
-            #form = form.encode('utf-8')
-            #report(verbose, 'Downloading night log for {}', isodate)
-            with request.urlopen() as response:
-                page = response.read()
-            # save file and load it
+            with span('list fetch'):
+                page = request.fetch()
             mkdir(filepath)
             report(verbose, 'Writing night log {}', filename)
-            open(filename, 'wb').write(page)
-            table = parse_single_table(filename, pedantic=False)
-        array = table.array
-        #keep = (array['ins_id'] != b'GROND') + (array['exptime'] != 10)
-        #array = array[keep]
-        # 2018-02-20
-        # return array['dp_id']
-        return array['dp_id'].data
+            with open(filename + '.tmp', 'wb') as fh:
+                fh.write(page)
+            os.replace(filename + '.tmp', filename)
+        if clobber:
+            fetch()
+        #
+        # Read the file.  A saved listing that is missing or does not
+        # parse (e.g. truncated) is fetched again and the rows not yet 
+        # yielded are read from the new one.
+        #
+        done = set()
+        try:
+            for row in iter_votable_rows(filename, names=names):
+                done.add(row)
+                yield row[0] if len(names) == 1 else row
+        except (OSError, SyntaxError, ValueError) as e:
+            if clobber:
+                raise
+            report(verbose, 'Cannot read night log {} ({}), fetch it again',
+                    filename, e)
+            fetch()
+            for row in iter_votable_rows(filename, names=names):
+                if row not in done:
+                    yield row[0] if len(names) == 1 else row
+    def get_night_list(self, verbose=1, clobber=False):
+        return list(self.iter_night_list(verbose=verbose, clobber=clobber))
+    def refresh_night_list(self, verbose=1):
+        # Download the archive listing again and diff it with the stored
+        # one.  Returns the new listing and the dp_ids it adds.
+        known = []
+        if os.path.exists(self.get_path(fileext='xml')):
+            try:
+                known = self.get_night_list(verbose=verbose)
+            except:
+                known = []
+        datalist = self.get_night_list(verbose=verbose, clobber=True)
+        known = set(known)
+        newids = [d for d in datalist if d not in known]
+        report(verbose, '{} new frames in night list ({} total)', 
+                len(newids), len(datalist))
+        return datalist, newids
     @staticmethod
     def load_keyword(row, header):
         dtype = numpy.dtype(row['type'])
@@ -324,15 +450,31 @@ class BasicLog(Table):
             value = value.ljust(row['width']) 
         return value
     @classmethod
+    def keywords_hash(cls):
+        if '_keywords_hash' not in BasicLog.__dict__:
+            BasicLog._keywords_hash = keyword_table_hash(cls.keywords)
+        return BasicLog._keywords_hash
+    def get_keyword_cache(self):
+        filename = self.get_path(fileext=CACHE_EXT)
+        columns = self.keywords.columns
+        cache = KeywordCache(filename, columns['name'], columns['type'],
+                    self.keywords_hash())
+        return cache.load()
+    @classmethod
     def load_keywords(cls, header):
         if isinstance(header, str):
             with pyfits.open(header) as h:
                 return cls.load_keywords(h)
         values = [cls.load_keyword(row, header) for row in cls.keywords]
         return values
+    @classmethod
+    def keyword_parser(cls):
+        if '_keyword_parser' not in BasicLog.__dict__:
+            BasicLog._keyword_parser = CardParser(cls.keywords)
+        return BasicLog._keyword_parser
     def date_interval(self, name, time_only=False, time_value=False):
         date = self.meta[name]
-        t = sum(time_delta(d1, d2) for d1, d2 in date)
+        t = IntervalSet(date).measure()
         if time_value:
             return t
         if time_only:
@@ -372,48 +514,92 @@ class BasicLog(Table):
     def read(cls, tel, period=None, night=None, filename=None, clobber=None, 
             clobberHeaderList=False, clobberLastNights=False, compact=True,
             format= 'ascii.fixed_width_two_line', fileext='.dat', path='.',
-            **kwarg):
+            jobs=1, incremental=False, mirror='http://archive.eso.org',
+            processes=1, categorical=False, **kwarg):
+        # categorical: dictionary-encode the string columns (see
+        # encode_categories) as soon as rows are read
         print('def read', cls)
         iokwarg = {a: b for a,b in kwarg.items() if a[:7] != 'clobber'}
         clobberarg = {a: b for a,b in kwarg.items() if a[:7] == 'clobber'}
-        emptylog = cls(tel=tel, period=period, night=night, path=path)
+        emptylog = cls(tel=tel, period=period, night=night, path=path,
+                mirror=mirror)
         print('empty log done')
-        if night is not None and clobberLastNights:
-            dt = datetime.date.today() - parse_date(night).date()
-            if dt.total_seconds() < 3 * 86400:
-                clobber = True
-                clobberHeaderList = True
         if filename is None:
             filename = emptylog.get_path(fileext=fileext)
-        if not clobber:
-            print('try to read log', night, period)
-            try:
-                log = super().read(filename, format=format, 
-                        fill_values=None, **iokwarg)
-                print('sucess reading', type(log).__name__, night, period)
-                for col in log.colnames:
-                    if ' ' in col:
-                        log.columns[col].name = re.sub(' ', '_', col)
-                log = cls(log, meta=emptylog.meta)
-            except:
-                print('error reading', cls.__name__, filename)
-                clobber = True
-        if clobber:
-            print('generate', cls.__name__, path)
-            log = cls.generate(tel, period, night, filename=filename, 
-                compact=compact,
-                clobberHeaderList=clobberHeaderList, path=path, **kwarg)
-        log.fix_pids()
-        log.fix_targets()
-        log.fix_filters()
-        if clobber:
-            log.write(filename, format=format, **iokwarg) 
-            if compact:
-                base, ext = os.path.splitext(filename)
-                filename = '{}-compact{}'.format(base, ext)
-                log.write(filename, format=format, compact=True, **iokwarg)
+        # Timing of the whole night/period (mpglogs --profile)
+        name = str(night) if night is not None else 'P{}'.format(period)
+        profile = None
+        if profiler.enabled:
+            profile = emptylog.get_path(fileext='-profile.json')
+        with span(name, filename=profile):
+            if night is not None and clobberLastNights:
+                if is_recent_night(night):
+                    if incremental:
+                        # Regenerate only if the archive lists new frames. 
+                        # Other frames come from the keyword cache, so only
+                        # new headers are fetched and parsed.
+                        datalist, newids = emptylog.refresh_night_list()
+                        if len(newids) or not os.path.exists(filename):
+                            clobber = True
+                    else:
+                        clobber = True
+                        clobberHeaderList = True
+            if not clobber:
+                print('try to read log', night, period)
+                try:
+                    log = cls.load(filename, emptylog.meta, format=format,
+                            **iokwarg)
+                    if categorical:
+                        log.encode_categories()
+                    print('sucess reading', type(log).__name__, night, period)
+                except:
+                    print('error reading', cls.__name__, filename)
+                    clobber = True
+            if clobber:
+                print('generate', cls.__name__, path)
+                log = cls.generate(tel, period, night, filename=filename, 
+                    compact=compact, jobs=jobs, incremental=incremental,
+                    mirror=mirror, processes=processes,
+                    categorical=categorical,
+                    clobberLastNights=clobberLastNights,
+                    clobberHeaderList=clobberHeaderList, path=path, **kwarg)
+            with span('fix_pids'):
+                log.fix_pids()
+            with span('fix_targets'):
+                log.fix_targets()
+            with span('fix_filters'):
+                log.fix_filters()
+            if clobber:
+                with span('write'):
+                    log.write(filename, format=format, **iokwarg) 
+                if compact:
+                    base, ext = os.path.splitext(filename)
+                    filename = '{}-compact{}'.format(base, ext)
+                    with span('write compact'):
+                        log.write(filename, format=format, compact=True, 
+                                **iokwarg)
+                if night is not None:
+                    with span('write rollup'):
+                        log.save_rollup()
         return log
     @classmethod
+    def load(cls, filename, meta, format='ascii.fixed_width_two_line',
+            **iokwarg):
+        log = super().read(filename, format=format, fill_values=None, 
+                **iokwarg)
+        for col in log.colnames:
+            if ' ' in col:
+                log.columns[col].name = re.sub(' ', '_', col)
+        return cls(log, meta=meta)
+    @classmethod
+    def enforce_cache(cls, tel, budget, path='.', policy='lru', pinned=[]):
+        # Evict downloaded data of closed periods beyond budget (bytes).
+        # The current period is always pinned.
+        current = cls.night_to_period(isoformat(lastnight()))
+        pinned = [current, *pinned]
+        manager = CacheManager(path, tel, budget, policy=policy, pinned=pinned)
+        return manager.enforce()
+    @classmethod
     def empty(cls, tel, period=None, night=None, path='.'):
         log = cls()
     @classmethod
@@ -428,10 +614,101 @@ class BasicLog(Table):
             return Table(self, copy=False)[i]
         return super().__getitem__(i) 
     def onsky(self):
-        keep =  (self.internal != 1) * (self.obs_type != 'FLAT,SCREEN')
+        screen = self.column_equals('obs_type', 'FLAT,SCREEN')
+        keep =  (self.internal != 1) * ~screen
         return self[keep]
+    def encode_categories(self, names=None):
+        # Replace string columns by integer codes into the sorted values 
+        # stored in meta['categories'] (masks and group-bys on codes)
+        categories = self.meta.setdefault('categories', {})
+        if names is None:
+            names = self.categorical
+        for name in names:
+            if name not in categories:
+                values, codes = unique(self[name], return_inverse=True)
+                categories[name] = values
+                self.replace_column(name, self.recolumn(name, 
+                        codes.astype('int32')))
+        return self
+    def decode_categories(self, names=None):
+        categories = self.meta.get('categories', {})
+        if names is None:
+            names = list(categories)
+        for name in names:
+            if name in categories:
+                col = self.recolumn(name, self.column_values(name))
+                self.replace_column(name, col)
+                del categories[name]
+        if not categories:
+            self.meta.pop('categories', None)
+        return self
+    def decoded(self, names=None):
+        # Copy with (some) encoded columns back to strings
+        if not self.meta.get('categories'):
+            return self
+        log = self.copy(copy_data=False)
+        log.meta['categories'] = dict(self.meta['categories'])
+        return log.decode_categories(names)
+    def recolumn(self, name, values):
+        # Column with new values and the format, unit and description
+        col = self.columns[name]
+        return Column(values, name=name, unit=col.unit, format=col.format,
+                    description=col.description)
+    def set_values(self, name, rows, values):
+        # self[name][rows] = values, adding values to the categories of an
+        # encoded column (codes are renumbered to stay in value order)
+        categories = self.meta.get('categories', {})
+        if name not in categories:
+            self[name][rows] = values
+            return
+        self.invalidate_indexes()
+        labels = categories[name]
+        new = numpy.setdiff1d(values, labels)
+        if len(new):
+            merged = numpy.union1d(labels, new)
+            renumber = numpy.searchsorted(merged, labels).astype('int32')
+            self[name][:] = renumber[array(self[name])]
+            categories[name] = labels = merged
+        self[name][rows] = numpy.searchsorted(labels, values)
+    def map_values(self, name, fun):
+        # Apply fun to each value of a column, to each category only if
+        # the column is encoded
+        categories = self.meta.get('categories', {})
+        if name not in categories:
+            self[name] = [fun(v) for v in self[name]]
+            return
+        self.invalidate_indexes()
+        labels, renumber = unique([fun(v) for v in categories[name]],
+                    return_inverse=True)
+        categories[name] = labels
+        self[name][:] = renumber.astype('int32')[array(self[name])]
+    def column_values(self, name):
+        categories = self.meta.get('categories', {})
+        if name in categories:
+            return categories[name][self[name]]
+        return array(self[name])
+    def encode_value(self, name, value):
+        # Code of value in an encoded column (-1 if absent)
+        categories = self.meta.get('categories', {})
+        if name not in categories:
+            return value
+        code = numpy.flatnonzero(categories[name] == value)
+        return code[0] if len(code) else -1
+    def column_equals(self, name, value):
+        return self[name] == self.encode_value(name, value)
+    def query(self, name, value):
+        # Row numbers where column name equals value, by binary search on
+        # a sorted index for the indexed columns
+        value = self.encode_value(name, value)
+        if name in self.indexed:
+            return super().query(name, value)
+        return numpy.flatnonzero(self[name] == value)
     def write(self, fh=None, format= 'ascii.fixed_width_two_line', 
             compact=False, **kwarg):
+        # Compact logs are binned on codes and decoded per row 
+        if self.meta.get('categories') and not compact:
+            self.decoded().write(fh, format=format, **kwarg)
+            return
         if not compact:
             super().write(fh, format=format, **kwarg)
             return
@@ -466,9 +743,55 @@ class BasicLog(Table):
         log.write(fh=fh, format=format, compact=False, **kwarg)
     def bin(self, keys=('period', 'night', 'tac', 'tac_pid', 'ins',
                 'target', 'filter'), sort_by_keys=False):
+        # Encoded columns are grouped and reduced on their codes (sorted
+        # as the values) and decoded per group
         tab = self.group_by(keys, sort_by_keys=sort_by_keys)
-        tab = tab.groups.aggregate(self.aggregate_function)
-        return tab
+        tab = tab.aggregate_groups()
+        return tab.decoded()
+    def aggregate_groups(self):
+        # Reduce each group to a row with the vectorised reducers of
+        # get_reducer.  Key columns take the value of the group, other
+        # encoded columns are reduced to strings.
+        if len(self) == 0:
+            return self.copy()
+        seg = Segments(self.groups.indices)
+        keys = self.groups.key_colnames
+        categories = self.meta.get('categories', {})
+        cols = []
+        for col in self.columns.values():
+            if col.name in keys:
+                values = array(col)[seg.first]
+            elif col.name in categories:
+                labels = categories[col.name]
+                how, *arg = self.get_reducer(Column(labels, name=col.name))
+                if how in ['concat', 'majority']:
+                    values = reduce(array(col), seg, how, *arg, labels=labels)
+                else:
+                    values = reduce(labels[array(col)], seg, how, *arg)
+                cols.append(self.recolumn(col.name, values))
+                continue
+            else:
+                values = reduce(array(col), seg, *self.get_reducer(col))
+            # Numbers keep the column type (e.g. mean of int period)
+            if col.dtype.kind not in 'SU':
+                values = values.astype(col.dtype)
+            cols.append(self.recolumn(col.name, values))
+        meta = self.meta.copy()
+        if categories:
+            meta['categories'] = {name: labels for name, labels 
+                        in categories.items() if name in keys}
+        return type(self)(cols, meta=meta, copy=False)
+    @classmethod
+    def get_reducer(cls, col):
+        # Same rules as aggregate_function, as (reducer, *arg)
+        name = col.name
+        if name in cls.reducers:
+            return cls.reducers[name]
+        if name[-4:] == 'time' or name == 'nexp':
+            return ('sum',)
+        if col.dtype.char in 'SU':
+            return ('concat',)
+        return ('mean',)
     def aggregate(self, fun):
         rows = [list(fun(col) for col in group.columns.values()) 
                     for group in self.groups]
@@ -510,22 +833,18 @@ class BasicLog(Table):
         # Other numerical colues are averaged
         return col.mean() 
     def set_exectime(self):
-        self.time = time_delta(self.start, self.end)
+        # Array arithmetic on datetime64, ISO strings are only parsed once
+        start, end = to_datetime64(self.start), to_datetime64(self.end)
+        self.time = to_hours(end - start)
         self.ob_time = max(time_delta(self.ob_start, self.ob_end), 0)
         self.tpl_time = max(time_delta(self.tpl_start, self.tpl_end), 0)
         if self.ephemeris:
-            self.dark_time = 0.
-            for s, e in self.dark_hours:
-                start, end = max(s, self.start), min(e, self.end)
-                self.dark_time += max(time_delta(start, end), 0)
-            self.night_time = 0.
-            for s, e in self.night_hours:
-                start, end = max(s, self.start), min(e, self.end)
-                self.night_time += max(time_delta(start, end), 0)
-            self.twilight_time = 0.
-            for s, e in self.twilight_hours:
-                start, end = max(s, self.start), min(e, self.end)
-                self.twilight_time += max(time_delta(start, end), 0)
+            dark = IntervalSet(self.dark_hours)
+            night = IntervalSet(self.night_hours)
+            twilight = IntervalSet(self.twilight_hours)
+            self.dark_time = dark.overlap(start, end)
+            self.night_time = night.overlap(start, end)
+            self.twilight_time = twilight.overlap(start, end)
         internal = self.internal == 1
         self.night_time[internal] = 0
         self.twilight_time[internal] = 0
@@ -551,19 +870,51 @@ class BasicLog(Table):
             comments.append('')
         return comments 
     def set_overheads(self, gaptime=0.01):
-        indices = array(range(len(self)))
+        self.estimate_ends()
+        # If there is <1 min difference between end and start
+        # of an on-sky OB/template/exposure, fix the (badly estimated)
+        # end time.  Do it also for internal observations on the same
+        # instrument.
+        for internal in [False, True]:
+            index = numpy.flatnonzero(self['internal'] == internal)
+            if len(index) > 1:
+                self.join_ends(index, internal=internal, gaptime=gaptime)
+    def estimate_ends(self):
         # Find approximate date for the end of the exposure / ob 
-        self['end'] = [add_overhead(d, seconds=t + 30) if c != 'IDLE' else d
-            for d, t, c in zip(self['end'], self['read_time'], self['obs_cat'])]
+        end = add_overhead(self['end'], seconds=self['read_time'] + 30)
+        self['end'] = numpy.where(self['obs_cat'] != 'IDLE', end, self['end'])
         self['start'] = [s[0:19] for s in self['start']]
         self['tpl_end'] = self['end']
         self['ob_end'] = self['end']
         firstexp = self['expno'] == 1
         self['start'][firstexp] = self['tpl_start'][firstexp] 
-        # If there is <1 min difference between end and start
-        # of an on-sky OB/template/exposure, fix the (badly estimated)
-        # end time.  Do it also for internal observations on the same
-        # instrument.
+    def join_ends(self, index, internal=False, gaptime=0.01):
+        # Each row of index is compared with the next one: same template,
+        # same OB, or OB starting less than gaptime after the end.  The
+        # template/OB end is the one of the last row of the template/OB.
+        cur, nxt = index[:-1], index[1:]
+        start, end = array(self['start']), array(self['end'])
+        tpl_start, ob_start = array(self['tpl_start']), array(self['ob_start'])
+        same_tpl = tpl_start[cur] == tpl_start[nxt]
+        same_ob = ~same_tpl * (ob_start[cur] == ob_start[nxt])
+        gap = ~same_tpl * ~same_ob
+        if internal:
+            gap *= array(self['ins'][cur]) == array(self['ins'][nxt])
+        gap[gap] = time_delta(end[cur][gap], ob_start[nxt][gap]) < gaptime
+        last = end[index[-1:]]
+        joined = numpy.where(gap, ob_start[nxt], end[cur])
+        new_end = numpy.where(same_tpl + same_ob, start[nxt], joined)
+        tpl_end = numpy.where(same_ob, tpl_start[nxt], joined)
+        self['end'][cur] = new_end
+        self['tpl_end'][index] = fill_backward(numpy.hstack([tpl_end, last]),
+                numpy.hstack([same_tpl, False]))
+        self['ob_end'][index] = fill_backward(numpy.hstack([joined, last]),
+                numpy.hstack([same_tpl + same_ob, False]))
+    def _set_overheads_rowwise(self, gaptime=0.01):
+        # Former row-by-row implementation, kept as a reference for
+        # exec/mpgcheckoverheads
+        indices = array(range(len(self)))
+        self.estimate_ends()
         for internal in [False, True]:
             prevrow = None
             #j = None
@@ -605,53 +956,66 @@ class BasicLog(Table):
         self['target'][screen] = 'SCREEN'
         self['track'][screen] = 'OFF'
         #  2. All templates of an OB are internal calibrations
-        internal_type = numpy.atleast_2d(['DARK', 'BIAS', 'FLAT', 'WAVE']).T
-        for ob in numpy.unique(self['ob_start']):
-            index = self['ob_start'] == ob
-            typ = numpy.atleast_2d([t.strip() for t in self['obs_type'][index]])
-            if all(numpy.sum(typ == internal_type, axis=0)):
-                self['target'][index] = 'INTERNAL'
-                self['track'][index] = 'OFF'
-                self['internal'][index] = True 
+        if not len(self):
+            return
+        typ = numpy.char.strip(array(self['obs_type']))
+        calib = numpy.isin(typ, ['DARK', 'BIAS', 'FLAT', 'WAVE'])
+        order, first = sorted_segments(self['ob_start'])
+        calib_ob = numpy.logical_and.reduceat(calib[order], first)
+        index = numpy.empty(len(self), dtype=bool)
+        index[order] = numpy.repeat(calib_ob, segment_lengths(first, len(self)))
+        self['target'][index] = 'INTERNAL'
+        self['track'][index] = 'OFF'
+        self['internal'][index] = True 
     def fix_pids(self):
+        # Programmes are looked up once per distinct (pid, target, date)
+        # and broadcast back to the frames.  Target and date are only
+        # part of the key for PIDs with corrections in the programme list.
         tel = self.meta['telescope']
+        path = self.get_path(level='base')
+        pid, target = self.column_values('pid'), self.column_values('target')
+        date, ins = array(self['start']), self.column_values('ins')
+        dummy = (date == 'DUMMY') * (array(self['end']) == 'DUMMY')
         for period in numpy.unique(self['period']):
-            path = self.get_path(level='base')
+            rows = numpy.flatnonzero((self['period'] == period) * ~dummy)
+            if not len(rows):
+                continue
             progs = ProgramList(tel, period, path=path)
-            for i, row in enumerate(self):
-                if row['period'] != period:
-                    continue
-                pid = row['pid']
-                target = row['target']
-                date = row['start']
-                ins = row['ins']
-                if date == 'DUMMY' and row['end'] == 'DUMMY':
-                    continue
-                p = progs.lookup(pid, target=target, date=date, ins=ins)
-                if pid == '0104.A-9099(A)':
-                    print(pid, target, p)
-                row['pi'] =  p['Surname'] 
-                if (p['Name'] not in ['', 'N/A'] 
-                        and p['Surname'] not in ['', 'N/A']):
-                    row['pi'] = p['Surname'] # + ' ' + p['Name']
-                else:
-                    row['pi'] = 'N/A'
-                row['tac'] = p['TAC'] 
-                row['tac_pid'] = p['PID']
-                if row['tac_pid'][0:2] == '60' and row['obs_cat'] == 'SCIENCE':
-                    row['obs_cat'] = 'CALIB'
+            corrected = [p for p in numpy.unique(pid[rows]) 
+                            if progs.has_corrections(p)]
+            bydate = numpy.isin(pid[rows], corrected)
+            keys = numpy.rec.fromarrays([pid[rows], 
+                numpy.where(bydate, target[rows], ''),
+                numpy.where(bydate, date[rows], '')])
+            keys, first, inverse = numpy.unique(keys, return_index=True,
+                    return_inverse=True)
+            first = rows[first]
+            found = [progs.lookup(pid[i], target=target[i], date=date[i],
+                        ins=ins[i]) for i in first]
+            pi = ['N/A' if p['Name'] in ['', 'N/A'] 
+                    or p['Surname'] in ['', 'N/A'] else p['Surname'] 
+                        for p in found]
+            self['pi'][rows] = array(pi)[inverse]
+            self.set_values('tac', rows, 
+                    array([p['TAC'] for p in found])[inverse])
+            self['tac_pid'][rows] = array([p['PID'] for p in found])[inverse]
+            tac_pid = array(self['tac_pid'][rows])
+            calib = numpy.char.startswith(tac_pid, '60')
+            calib *= self.column_equals('obs_cat', 'SCIENCE')[rows]
+            self.set_values('obs_cat', rows[calib], 'CALIB')
+        self.invalidate_indexes()
     def set_night(self, night):
         if len(self):
             self['night'] = night
             self['period'] = self.night_to_period(night)
     def fix_targets(self):
         if len(self):
-            self.target = [re.sub('[_-]([0-9]{1,2}|[UBVRI])$', '', t) 
-                    for t in self.target]
+            self.map_values('target', 
+                    lambda t: re.sub('[_-]([0-9]{1,2}|[UBVRI])$', '', t))
     def fix_filters(self):
         if len(self):
-            self.filter = [re.sub('^[NMB]B#(.*)_ESO[0-9]+$', '\\1', t)
-                    for t in self.filter]
+            self.map_values('filter', 
+                    lambda t: re.sub('^[NMB]B#(.*)_ESO[0-9]+$', '\\1', t))
     def total_night_time(self):
         return self.date_interval('night_hours', time_value=True)
     def total_twilight_time(self):
@@ -663,19 +1027,44 @@ class BasicLog(Table):
     def summary(self):
         tab = self.bin(['tac', 'tac_pid'], sort_by_keys=True)
         return tab
+    def rollup(self):
+        # Times and last end per (tac, tac_pid, ins, obs_cat), grouped on
+        # the codes of encoded columns and decoded per rollup row
+        names = self.rollup_keys + self.rollup_times + ['end']
+        tab = sum_rollups(Table([array(self[name]) for name in names], 
+                    names=names))
+        categories = self.meta.get('categories', {})
+        for name in self.rollup_keys:
+            if name in categories:
+                tab.replace_column(name, Column(
+                    categories[name][array(tab[name])], name=name))
+        return tab
 
 class SinglePeriodLog(BasicLog):
     def get_period(self):
         return self.meta['period']
+    def programmes_hash(self):
+        # Programme list the tac and tac_pid columns are resolved with
+        filename = get_program_filename(self.telescope, self.get_period(), 
+                path=self.get_path(level='period'), format='xls')
+        sha = hashlib.sha1()
+        try:
+            with open(filename, 'rb') as fh:
+                sha.update(fh.read())
+        except OSError:
+            return ''
+        return sha.hexdigest()
     def report_use(self, show=False):
-        total = sum(self['time'])
-        night = sum(self['night_time'])
-        shut = sum(self['exptime']) / 3600.
+        # Sums of the rollup rows, not of the frames
+        rollup = self.rollup()
+        total = sum(rollup['time'])
+        night = sum(rollup['night_time'])
+        shut = sum(rollup['exptime']) / 3600.
         rows = [('ALL', 'all', total, night, shut, 0.)]
         categories =  ['SCIENCE', 'CALIB', 'ACQUISITION', 'IDLE']
-        instruments = unique(self['ins'])
+        instruments = unique(array(rollup['ins']))
         for cat in categories:
-            log0 = self[self['obs_cat'] == cat]
+            log0 = rollup[array(rollup['obs_cat']) == cat]
             total = sum(log0['time'])
             night = sum(log0['night_time'])
             shut = sum(log0['exptime']) / 3600.
@@ -684,7 +1073,7 @@ class SinglePeriodLog(BasicLog):
                 noins = ins[0:6] in ['NONE', 'INSCH', 'INSCHA']
                 if (cat == 'IDLE' and not noins) or (cat != 'IDLE' and noins):
                     continue
-                log1 = log0[log0['ins'] == ins]
+                log1 = log0[array(log0['ins']) == ins]
                 total = sum(log1['time'])
                 night = sum(log1['night_time'])
                 shut = sum(log1['exptime']) / 3600.
@@ -725,7 +1114,7 @@ class SinglePeriodLog(BasicLog):
         for name in ['Completion']:
             col = Column(name=name, dtype=float, length=length, format='{:.0%}')
             progs.add_column(col, index=itime + 1)
-        summary = self.bin(['tac', 'tac_pid'], sort_by_keys=True)
+        summary = sum_rollups(self.rollup(), keys=['tac', 'tac_pid'])
         # Loop on program rows to add accounting times 
         voidrow = numpy.array(progs[0].as_void())
         voidrow['TAC'] = 'N/A'
@@ -738,13 +1127,15 @@ class SinglePeriodLog(BasicLog):
         for row in summary:
             pid = row['tac_pid']
             ins = row['ins']
-            if pid not in progs['PID']:
+            found = progs.query('PID', pid)
+            if not len(found):
                 progs.add_row(voidrow.item())
                 prow = progs[-1]
                 prow['PID'] = pid
                 prow['Instrument'] = ins
+                progs.invalidate_indexes()
             else:
-                i = numpy.argwhere(pid == progs['PID'])[0][0]
+                i = found[0]
                 prow = progs[i]
             prow['Night time'] = row['night_time']
             prow['Exposure time'] = row['exptime'] / 3600.
@@ -797,6 +1188,12 @@ class SinglePeriodLog(BasicLog):
         return progs
 
 class NightLog(SinglePeriodLog):
+    def rollup_file(self):
+        return self.get_path(fileext='-rollup.ecsv')
+    def save_rollup(self):
+        # Written with the night log, read by PeriodLog.rollup
+        write_rollup(self.rollup(), self.rollup_file(), 
+                self.programmes_hash())
     def __str__(self):
         names = ['period', 'night', 'start', 'end', 'ob_start', 'tpl_start',
             'ins', 'pid', 'target', 'exptime', 'nexp', 'internal']
@@ -824,135 +1221,126 @@ class NightLog(SinglePeriodLog):
         return 'Log for night {} (ESO Period {} at {})'.format(date, per, tel)
     def fill_gaps(self):
         if len(self) != 0:
-            self.sort()
-            self.set_overheads()
-            self.insert_acquisition()
+            with span('sort'):
+                self.sort()
+            with span('set_overheads'):
+                self.set_overheads()
+            with span('insert_acquisition'):
+                self.insert_acquisition()
             if self.telescope == '2.2m':
-                self.insert_focus(pid='60.A-9120(A)', focustime=0.15, 
-                        newins='WFI')
-                self.insert_inschange(changetime=0.03)
+                with span('insert_focus'):
+                    self.insert_focus(pid='60.A-9120(A)', focustime=0.15, 
+                            newins='WFI')
+                with span('insert_inschange'):
+                    self.insert_inschange(changetime=0.03)
+            with span('set_overheads'):
+                self.set_overheads()
+        with span('insert_gap'):
+            self.insert_gap()
+        with span('set_overheads'):
             self.set_overheads()
-        self.insert_gap()
-        self.set_overheads()
-        self.set_exectime()
+        with span('set_exectime'):
+            self.set_exectime()
         self.set_comments()
     @classmethod
     def generate(cls, tel, period=None, night=None, filename=None, 
             clobberLastNights=False, compact=False, path='.',
             clobberHeaderList=False, clobberHeader=False, fileext='.dat',
-            verbose=2):
+            jobs=1, incremental=False, mirror='http://archive.eso.org',
+            processes=1, categorical=False, verbose=2):
+        # processes: a night is generated in a single process.
         # Determine whether to download night log again (if recent some
         # archives may be lacking)
         print('generate nightlog', clobberHeader)
         if night is None:
             night = isoformat(lastnight())
         period = cls.night_to_period(night)
-        emptylog = cls(tel=tel, period=period, night=night, path=path)
-        datalist = emptylog.get_night_list(clobber=clobberHeaderList, 
-                    verbose=verbose - 1)
-        #if len(datalist) == 0:
-        #    datalist = [b'inexistentheader']
-        headers = [emptylog.get_header(dataid, clobber=clobberHeader, 
-                verbose=verbose - 1) 
-                for dataid in datalist]
-        # Load from FITS files
-        rows = [cls.load_keywords(h) for h in headers]
+        emptylog = cls(tel=tel, period=period, night=night, path=path,
+                mirror=mirror)
+        # Keywords already extracted with the current esolog.dat are
+        # cached, only headers of new frames are fetched and parsed.
+        # Fetching starts while the night list is being read.
+        mkdir(emptylog.get_path())
+        touch(emptylog.get_path())
+        cache = emptylog.get_keyword_cache()
+        if clobberHeader:
+            cache.clear()
+        datalist, missing = [], []
+        def missing_headers():
+            for dataid in emptylog.iter_night_list(clobber=clobberHeaderList, 
+                        verbose=verbose - 1):
+                datalist.append(dataid)
+                if dataid not in cache:
+                    missing.append(dataid)
+                    yield dataid
+        with span('header fetch'):
+            headers = emptylog.get_headers(missing_headers(), jobs=jobs, 
+                    raw=True, clobber=clobberHeader, verbose=verbose - 1)
+        # Release the pack (mmap and file) once the night is fetched
+        emptylog.get_header_pack().forget()
+        # Load from FITS header cards
+        with span('keyword parse'):
+            cache.update(missing, cls.keyword_parser().load_rows(headers))
+            cache.save()
         # Generate the night
-        log = cls(rows=rows, meta=emptylog.meta)
+        log = cls(cache.get_columns(datalist), meta=emptylog.meta)
         # Several elements are missing or incorrect: programme IDs observed
         # under "emergency" accounts, target/filtre names, missing 
         # observations (acquisitions, focus and true downtimes)
         log.set_night(night)
-        log.flag_internal_obs()
-        log.sort()
-        log.fix_pids()
-        log.fix_targets()
-        log.fix_filters()
-        log.fill_gaps()
+        with span('flag_internal_obs'):
+            log.flag_internal_obs()
+        with span('sort'):
+            log.sort()
+        with span('fix_pids'):
+            log.fix_pids()
+        with span('fix_targets'):
+            log.fix_targets()
+        with span('fix_filters'):
+            log.fix_filters()
+        with span('fill_gaps'):
+            log.fill_gaps()
         log.set_night(night)
         return log
     def set_ephemeris(self):
+        # Shared per-period table, unless frames give the site
         self.ephemeris = True
-        sun = ephem.Sun()
-        moon = ephem.Moon()
-        obs = ephem.Observer()
         if len(self):
             lon, lat, alt = self['lon'][0], self['lat'][0], self['alt'][0]
+            eph = night_ephemeris(self.get_night(), lon, lat, alt)
         else:
-            if self.telescope in ['2.2m', 'NTT', '3.6m']:
-                lon, lat, alt = -70.7346, -29.2543, 2350
-            else:
-                raise RuntimeError('Unimplemented telescope')
-        obs.date = parse_date(self.get_night())
-        obs.date += 1 - lon / 360
-        obs.lon = lon * pi / 180
-        obs.lat = lat * pi / 180
-        obs.elev = alt
-        obs.pressure = 0
-        obs.temp = 0
-        sun.compute(obs)
-        moon.compute(obs)
-        # Night
-        obs.horizon = '-18:00' 
-        ne, ns = [isoformat(f(sun, use_center=True).datetime()) 
-                     for f in [obs.next_rising, obs.previous_setting]]
-        self.meta['night_hours'] = [(ns, ne)]
-        # Astronomical twilight
-        obs.horizon = '-12:00'
-        te, ts = [isoformat(f(sun, use_center=True).datetime()) 
-                     for f in [obs.next_rising, obs.previous_setting]]
-        self.meta['twilight_hours'] = [(ts, ns), (ne, te)]
-        # Sunrise/Sunset
-        obs.horizon = '-2:00' 
-        sr, ss = [isoformat(f(sun, use_center=False).datetime()) 
-                     for f in [obs.next_rising, obs.previous_setting]]
-        self.meta['sundown_hours'] =  [(ss, sr)]
-        # Moon
-        self.meta['fli'] = moon.moon_phase
-        dark = []
-        if moon.neverup:
-            dark = [(ns, ne)]
-        elif not moon.circumpolar:
-            obs.date = parse_date(ns)
-            # moon
-            mr, ms = [isoformat(f(moon, use_center=False).datetime()) 
-                     for f in [obs.next_rising, obs.next_setting]]
-            self.meta['moon_rise'] = mr
-            self.meta['moon_set'] = ms
-            if ms < mr:
-                ds, de = min(ms, ne), min(mr, ne)
-                if ds < de:
-                    dark = [(ds, de)]
-            else:
-                ds1, de1 = ns, min(mr, ne)
-                if ds1 < de1:
-                    dark = [(ds1, de1)]
-                ds2, de2 = min(ms, ne), min(mr, ne)
-                if ds2 < de2:
-                    dark.append((ds2, de2))
-        self.meta['dark_hours'] = dark
-    def add_default_row(self, row=None, start=None, end=None, dt=None, pid=None,
-                 replace_values=True, target='N/A', ins='NONE',
+            eph = get_night_ephemeris(self.telescope, self.get_night(),
+                    path=self.meta.get('path'))
+        self.meta.update(eph)
+    def add_default_row(self, row=None, **kwarg):
+        rows = None if row is None else [row]
+        self.extend(self.default_rows(rows, **kwarg))
+    def default_rows(self, rows=None, n=1, start=None, end=None, dt=None, 
+                 pid=None, replace_values=True, target='N/A', ins='NONE',
                  tec='N/A', cat='N/A', typ='N/A', filt='N/A',
                  name='N/A', pi='N/A', nexp=0):
-        if row is None:
-            row = self.get_defaults()
-        self.add_row(row)
-        gap = self[-1:]
+        # Synthetic rows based on rows (table or list of rows, n default 
+        # rows if None), to be merged in a single step with extend.
+        # start, end, dt and pid may be given for each row.
+        if rows is None:
+            rows = [self.get_defaults()] * n
+        if isinstance(rows, Table):
+            gap = type(self)(rows, meta=self.meta)
+        else:
+            gap = type(self)(rows=rows, meta=self.meta)
+        if len(gap) == 0:
+            return gap
         if dt is not None:
             start = add_overhead(end, seconds=-3600 * dt)
         if end is not None:
             gap.end, gap.tpl_end, gap.ob_end = end, end, end
         if start is not None:
             gap.start, gap.tpl_start, gap.ob_start = start, start, start
-        if pid is None:
-            gap.pid, gap.tac_pid = row['pid'], row['tac_pid']
-        else:
+        if pid is not None:
             gap.pid, gap.tac_pid = pid, pid
-        if gap.pid in ['N/A', 'IDLE']:
-            gap.tac = 'N/A'
+        gap.tac[numpy.isin(gap.pid, ['N/A', 'IDLE'])] = 'N/A'
         if replace_values:
-            gap.nexp = 0
+            gap.nexp = nexp
             gap.pi = pi
             gap.exptime, gap.read_time = 0., 0.
             gap.target, gap.ins = target, ins
@@ -960,6 +1348,7 @@ class NightLog(SinglePeriodLog):
             gap.obs_tech, gap.obs_cat, gap.obs_type = tec, cat, typ
             gap.filter = filt
             gap.ob_name = name 
+        return gap
     def insert_focus(self, newins='WFI', focustime=0.14, pid='60.A-9120(A)'):
         ins = self.ins
         dt = min(focustime, time_delta(self.ob_end[:-1], self.ob_start[1:])) 
@@ -969,11 +1358,10 @@ class NightLog(SinglePeriodLog):
         twstart, twend = self.twilight_start(), self.twilight_end()
         index *= (self.ob_end > twstart) * (self.ob_start < twend)
         index *= (self.ob_name != 'Focus') 
-        end = self.ob_start[index]
-        dt = dt[index]
-        for r, e, t in zip(self[index], end, dt):
-            self.add_default_row(r, end=e, dt=t, cat='ACQUISITION', pid=pid,
-                    ins=newins, target='Focus', name='Focus')
+        focus = self.default_rows(self[index], end=self.ob_start[index], 
+                dt=dt[index], cat='ACQUISITION', pid=pid, ins=newins, 
+                target='Focus', name='Focus')
+        self.extend(focus)
         self.sort()
     def insert_acquisition(self):
         obstart = self.ob_start
@@ -992,8 +1380,7 @@ class NightLog(SinglePeriodLog):
         acq.exptime = 0
         acq.readtime = 0
         acq.obs_cat = 'ACQUISITION'
-        for r in acq:
-            self.add_default_row(r, replace_values=False) 
+        self.extend(self.default_rows(acq, replace_values=False))
         self.sort()
     def insert_inschange(self, changetime=0.03):
         index = (self.track == 'NORMAL') 
@@ -1004,11 +1391,9 @@ class NightLog(SinglePeriodLog):
         index *= self.obs_tech != 'Instrument change'
         twstart, twend = self.twilight_start(), self.twilight_end()
         index *= (self.ob_end > twstart) * (self.ob_start < twend)
-        end = self.ob_start[index]
-        dt = dt[index]
-        for r, e, t in zip(self[index], end, dt):
-            self.add_default_row(r, end=e, dt=t,  
-                    pid='IDLE', cat='IDLE', ins='INSCHANGE')
+        change = self.default_rows(self[index], end=self.ob_start[index],
+                dt=dt[index], pid='IDLE', cat='IDLE', ins='INSCHANGE')
+        self.extend(change)
         self.sort()
     def insert_gap(self, gaptime=0.01):
         nstart, nend = self.night_start(), self.night_end()
@@ -1021,21 +1406,25 @@ class NightLog(SinglePeriodLog):
         onsky = self[self['internal'] != 1].copy()
         onsky.sort()
         lastrow = onsky[-1:].copy()[0]
-        # Determine the time gap between end of an OB and start
-        # of the next one.  Cut-off at twilight, so no gap outside
-        # night are reported
-        start = max(nstart, numpy.hstack([nstart, onsky.end]))
-        end = min(nend, numpy.hstack([onsky.start, nend])) 
-        hasgap = time_delta(start, end) >= gaptime
-        # Create new rows for each gap
-        start = start[hasgap] 
-        end = end[hasgap]
+        # Gaps are the night time not covered by on-sky observations, cut
+        # off at twilight so no gap outside night are reported
+        start = to_datetime64(onsky.start)
+        night = IntervalSet([(nstart, nend)])
+        free = night - IntervalSet.from_arrays(start, to_datetime64(onsky.end))
+        hasgap = to_hours(free.end - free.start) >= gaptime
+        # Create new rows for each gap, based on the observation that
+        # follows, including the one after the end of the night if any
+        # (a default row from the last one otherwise)
+        order = numpy.argsort(start, kind='stable')
+        following = numpy.searchsorted(start[order], free.end[hasgap])
         onsky.add_default_row(lastrow)
-        gaps = onsky[hasgap]
+        gaps = onsky[numpy.append(order, len(order))[following]]
         gaps.tac = 'N/A'
         gaps.track = 'OFF'
-        for s, e, gap in zip(start, end, gaps):
-            self.add_default_row(gap, start=s, end=e, pid='IDLE', cat='IDLE')
+        start = isoformat(free.start[hasgap])
+        end = isoformat(free.end[hasgap])
+        self.extend(self.default_rows(gaps, start=start, end=end, pid='IDLE',
+                cat='IDLE'))
         self.sort()
 
 class PeriodLog(SinglePeriodLog):
@@ -1058,18 +1447,100 @@ class PeriodLog(SinglePeriodLog):
         self.first_night = str(first)
         self.last_night = str(last)
         self.last_processed_night = str(last_processed)
-        # Loop on nights to determine individual nights' ephemeris
-        self.dark_hours = []
-        self.night_hours = []
-        self.twilight_hours = []
-        self.sundown_hours = []
-        for night in self.night_range():
-            log = NightLog(tel=self.telescope, night=night) 
-            self.dark_hours += log.dark_hours
-            self.night_hours += log.night_hours
-            self.twilight_hours += log.twilight_hours
-            self.sundown_hours += log.sundown_hours
+        # Individual nights' ephemeris from the shared period table
+        table = PeriodEphemeris.get(self.telescope, period, 
+                path=self.meta.get('path'))
+        nights = self.night_range()
+        self.dark_hours = table.intervals('dark_hours', nights)
+        self.night_hours = table.intervals('night_hours', nights)
+        self.twilight_hours = table.intervals('twilight_hours', nights)
+        self.sundown_hours = table.intervals('sundown_hours', nights)
         self.ephemeris = True
+    def night_log_file(self, night, ext='.dat'):
+        return os.path.join(self.get_path(), night, night + ext)
+    @staticmethod
+    def manifest_file(filename):
+        return os.path.splitext(filename)[0] + '-nights.json'
+    def night_stamps(self, nights, ext='.dat'):
+        # Modification time and size of the night logs
+        stamps = {}
+        for night in nights:
+            try:
+                st = os.stat(self.night_log_file(night, ext=ext))
+                stamps[night] = [st.st_mtime, st.st_size]
+            except OSError:
+                pass
+        return stamps
+    def save_manifest(self, filename, nights, ext='.dat'):
+        # Night log stamps the period log is built from.  Saved before the
+        # period log is written, so a period log older than its manifest
+        # is an incomplete build.
+        manifest = self.manifest_file(filename)
+        mkdir(os.path.dirname(manifest))
+        with open(manifest + '.tmp', 'w') as fh:
+            json.dump(self.night_stamps(nights, ext=ext), fh, indent=1)
+        os.replace(manifest + '.tmp', manifest)
+    def load_rows(self, filename, format='ascii.fixed_width_two_line'):
+        # Rows of a log file as a structured array with the keyword names
+        # and types (columns guessed from text may have another type)
+        tab = Table.read(filename, format=format, fill_values=None)
+        colnames = {re.sub(' ', '_', name): name for name in tab.colnames}
+        columns = self.keywords.columns
+        names, types = columns['name'].tolist(), columns['type'].tolist()
+        cols = [cast_column(tab[colnames[n]], t) for n, t in zip(names, types)]
+        return numpy.rec.fromarrays(cols, names=names).view(numpy.ndarray)
+    def load_previous(self, filename, nights, ext='.dat', 
+            clobberLastNights=False, verbose=1):
+        # Rows of the previous period log and nights to (re)read: night 
+        # logs changed or missing, and the last nights when they are 
+        # regenerated.
+        manifest = self.manifest_file(filename)
+        try:
+            if os.path.getmtime(filename) < os.path.getmtime(manifest):
+                report(verbose, 'Period log {} older than its manifest',
+                        filename)
+                return None, nights
+            with open(manifest, 'r') as fh:
+                stamps = json.load(fh)
+            previous = self.load_rows(filename)
+        except (OSError, ValueError, KeyError) as e:
+            report(verbose, 'Cannot update {} incrementally ({}: {})', 
+                    filename, type(e).__name__, e)
+            return None, nights
+        current = self.night_stamps(nights, ext=ext)
+        changed = [n for n in nights 
+                     if n not in current or current[n] != stamps.get(n)]
+        if clobberLastNights:
+            changed += [n for n in nights 
+                            if is_recent_night(n) and n not in changed]
+        return previous, changed
+    def rollup(self):
+        # Sum of the night rollups.  Rollups that are missing, older than
+        # their night log or made with another programme list are computed
+        # from the rows of the night (whose pids fix_pids resolved with
+        # the current list) and saved.
+        programmes = self.programmes_hash()
+        arrays = []
+        for night in self.night_range():
+            filename = self.night_log_file(night, ext='-rollup.ecsv')
+            logname = self.night_log_file(night)
+            try:
+                if os.path.getmtime(filename) >= os.path.getmtime(logname):
+                    tab = read_rollup(filename)
+                    if tab.meta.get('programmes') == programmes:
+                        arrays.append(tab.as_array())
+                        continue
+            except (OSError, ValueError):
+                pass
+            tab = BasicLog.rollup(self[self.query('night', night)])
+            arrays.append(tab.as_array())
+            if os.path.isdir(os.path.dirname(filename)):
+                write_rollup(tab, filename, programmes)
+        names = self.rollup_keys + self.rollup_times + ['end']
+        cols = concatenate_columns([a for a in arrays if len(a)])
+        if cols is None:
+            return super().rollup()
+        return sum_rollups(Table(cols, names=names))
     def info(self):
         tel, period = self.telescope, self.get_period()
         start, end = self.first_night, self.last_night
@@ -1084,17 +1555,57 @@ class PeriodLog(SinglePeriodLog):
     @classmethod
     def generate(cls, tel, period, night=None, filename=None, compact=False, 
             clobberNightLog=False, clobberLastNights=False, ext='.dat',
-            path='.', verbose=2, **kwarg):
-        rows = []
+            path='.', verbose=2, jobs=1, incremental=False,
+            mirror='http://archive.eso.org', processes=1, categorical=False,
+            **kwarg):
         print('generate')
-        emptylog = cls(tel=tel, period=period, path=path)
-        for night in emptylog.night_range():
-            nightlog = NightLog.read(tel, period=period, night=night, 
-                    compact=compact, path=path, 
-                    clobber=clobberNightLog, 
-                    clobberLastNights=clobberLastNights, **kwarg)
-            rows += nightlog.as_array().tolist()
-        log = PeriodLog(rows=rows, meta=emptylog.meta)
+        emptylog = cls(tel=tel, period=period, path=path, mirror=mirror)
+        # Night rows are encoded as they come, so that the string columns
+        # of the whole period are never held at once
+        encoder = CategoryEncoder(cls.categorical if categorical else [])
+        # Night logs are read (or generated and written) by the workers
+        # and gathered in night order
+        read_night = functools.partial(read_night_array, tel=tel, 
+                period=period, compact=compact, path=path, 
+                clobber=clobberNightLog, jobs=jobs, incremental=incremental,
+                mirror=mirror, clobberLastNights=clobberLastNights, **kwarg)
+        nights = emptylog.night_range()
+        if filename is None:
+            filename = emptylog.get_path(fileext=ext)
+        # Incremental: keep the rows of the previous build for the nights
+        # whose logs did not change since
+        arrays, changed = [], nights
+        if incremental and not clobberNightLog:
+            previous, changed = emptylog.load_previous(filename, nights, 
+                    ext=ext, clobberLastNights=clobberLastNights,
+                    verbose=verbose)
+            if previous is not None:
+                keep = ~numpy.isin(previous['night'], changed)
+                arrays = [encoder.encode(previous[keep])]
+                del previous
+            report(verbose, '{} of {} nights changed', len(changed), 
+                    len(nights))
+        if processes > 1:
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(processes, mp_context=context,
+                    initializer=init_night_worker,
+                    initargs=(profiler.enabled, processes)) as pool:
+                arrays += [encoder.encode(arr) 
+                                for arr in pool.map(read_night, changed)]
+        else:
+            arrays += [encoder.encode(read_night(night)) for night in changed]
+        emptylog.save_manifest(filename, nights, ext=ext)
+        with span('merge nights'):
+            cols = concatenate_columns(arrays)
+            meta = emptylog.meta
+            if categorical and cols is not None:
+                meta = meta.copy()
+                meta['categories'] = encoder.finish(cols, 
+                        arrays[0].dtype.names)
+            del arrays
+            log = PeriodLog(cols, meta=meta)
+            if len(changed) < len(nights):
+                log = log[numpy.argsort(log['night'], kind='stable')]
         log.set_comments()
         try:
             log = log.group_by(['period', 'night'])
@@ -1102,7 +1613,105 @@ class PeriodLog(SinglePeriodLog):
             print('error grouping log')
         return log
 
-        
+
+def init_night_worker(profile=False, processes=1):
+    # Workers share the archive request limits
+    profiler.enable(profile)
+    share_client(processes)
+
+class CategoryEncoder:
+    # Dictionary encoding of string fields of structured arrays, one array
+    # at a time.  Codes are given in order of appearance and renumbered in
+    # value order at the end, as encode_categories does.
+    def __init__(self, names):
+        self.codes = {name: {} for name in names}
+    def encode(self, arr):
+        if not self.codes:
+            return arr
+        cols = []
+        for name in arr.dtype.names:
+            col = arr[name]
+            if name in self.codes:
+                lookup = self.codes[name]
+                values, inverse = unique(col, return_inverse=True)
+                codes = array([lookup.setdefault(v, len(lookup)) 
+                            for v in values.tolist()], dtype='int32')
+                col = codes[inverse.ravel()]
+            cols.append(col)
+        return numpy.rec.fromarrays(cols, names=arr.dtype.names).view(
+                    numpy.ndarray)
+    def finish(self, cols, names):
+        # Renumber the codes of the concatenated columns (in place) and 
+        # return the categories
+        categories = {}
+        for name, col in zip(names, cols):
+            if name not in self.codes:
+                continue
+            labels = array(list(self.codes[name]), dtype=str)
+            order = numpy.argsort(labels, kind='stable')
+            renumber = numpy.empty(len(order), dtype='int32')
+            renumber[order] = numpy.arange(len(order))
+            if len(col):
+                col[:] = renumber[col]
+            categories[name] = labels[order]
+        return categories
+
+def concatenate_columns(arrays):
+    # Column-wise concatenation of structured arrays (columns matched by
+    # name, string widths may differ)
+    if not len(arrays):
+        return None
+    return [numpy.concatenate([arr[name] for arr in arrays])
+                for name in arrays[0].dtype.names]
+
+def cast_column(values, dtype):
+    # Column read from text to type dtype.  Strings keep their width, 
+    # booleans may have been read as 'True'/'False'.
+    values = numpy.asarray(values)
+    dtype = numpy.dtype(dtype)
+    if dtype.kind in 'SU' and values.dtype.kind in 'SU':
+        return values.astype(dtype.kind)
+    if dtype.kind == 'b' and values.dtype.kind in 'SU':
+        values = numpy.char.strip(values.astype(str))
+        if not numpy.all(numpy.isin(values, ['True', 'False'])):
+            raise ValueError('boolean column with other values')
+        return values == 'True'
+    return values.astype(dtype)
+
+def sum_rollups(tab, keys=BasicLog.rollup_keys):
+    # Rollup rows summed by keys: times added, last end, distinct values
+    # of the other keys joined (as bin does)
+    if not len(tab):
+        return tab
+    tab = tab.group_by(keys)
+    seg = Segments(tab.groups.indices)
+    cols = []
+    for name in tab.colnames:
+        values = array(tab[name])
+        if name in keys:
+            values = values[seg.first]
+        elif name in BasicLog.rollup_times:
+            values = reduce(values, seg, 'sum')
+        elif name == 'end':
+            values = reduce(values, seg, 'max')
+        else:
+            values = reduce(values, seg, 'concat')
+        cols.append(values)
+    return Table(cols, names=tab.colnames)
+
+def write_rollup(tab, filename, programmes):
+    # Through astropy's writer (gtable's does not handle ECSV options), to
+    # a temporary file renamed into place
+    tab = astropy.table.Table(tab, meta={'programmes': programmes})
+    tab.write(filename + '.tmp', format='ascii.ecsv', overwrite=True)
+    os.replace(filename + '.tmp', filename)
+
+def read_rollup(filename):
+    return astropy.table.Table.read(filename, format='ascii.ecsv')
+
+def read_night_array(night, tel, period, **kwarg):
+    # Night log as a structured array, for PeriodLog.generate workers
+    return NightLog.read(tel, period=period, night=night, **kwarg).as_array()
 
 def retrieve_fits_keywords(filename, keywords):
   if filename[~3:] == '.fits':
@@ -1115,4 +1724,4 @@ def retrieve_fits_keywords(filename, keywords):
   return [retrieve_fits_keyword(hdr, k[0], k[2]) for k in keywords]
 
 
-from MPG.programlist import ProgramList
+from MPG.programlist import ProgramList, get_program_filename
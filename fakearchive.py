@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+
+# Local stand-in for the ESO archive, serving the two pages used by the
+# night log builder:
+#
+#   /wdb/wdb/eso/eso_archive_main/query   night listing (VOTable)
+#   /hdr?DpId=<dp_id>                     FITS header in a <pre> block
+#
+# Pages come either from a recorded nightlogs tree (night XML listings
+# and header packs or .fits.hdr files, as written by esolog) or from
+# synthetic nights.  Latency and error rate are configurable, so the
+# download -> parse -> fill_gaps pipeline can be timed and checked
+# offline by pointing the log mirror at the stand-in.
+
+import os
+import re
+import glob
+import time
+import random
+import datetime
+import threading
+import urllib.parse
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape as xml_escape
+
+from MPG.headerpack import HeaderPack, PACK_EXT, read_header_textfile
+
+QUERY_PATH = '/wdb/wdb/eso/eso_archive_main/query'
+HEADER_PATH = '/hdr'
+
+def votable(rows):
+    # Minimal VOTable with the columns requested by get_night_list
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+        '<VOTABLE version="1.1" xmlns="http://www.ivoa.net/xml/VOTable/v1.1">',
+        '<RESOURCE><TABLE>',
+        '<FIELD name="dp_id" datatype="char" arraysize="*"/>',
+        '<FIELD name="exptime" datatype="double"/>',
+        '<FIELD name="ins_id" datatype="char" arraysize="*"/>',
+        '<DATA><TABLEDATA>']
+    for dataid, exptime, ins in rows:
+        lines.append('<TR><TD>{}</TD><TD>{}</TD><TD>{}</TD></TR>'.format(
+            xml_escape(dataid), exptime, xml_escape(ins)))
+    lines += ['</TABLEDATA></DATA>', '</TABLE></RESOURCE>', '</VOTABLE>']
+    return '\n'.join(lines).encode('utf-8')
+
+def header_page(text):
+    cards = [text[i:i+80].rstrip() for i in range(0, len(text), 80)]
+    if 'END' in cards:
+        cards = cards[0:cards.index('END') + 1]
+    body = escape('\n'.join(cards), quote=False)
+    page = '<html><body><pre>{}</pre></body></html>'.format(body)
+    return page.encode('utf-8')
+
+def query_night(form):
+    # ESO form gives night as dd mm yyyy, we use ISO dates
+    night = form.get('night', [''])[0]
+    m = re.match('([0-9]{2}) ([0-9]{2}) ([0-9]{4})$', night.strip())
+    if m is None:
+        return night.strip()
+    return '-'.join(m.groups()[::-1])
+
+def query_instruments(form):
+    add = form.get('add', [''])[0]
+    return re.findall("ins_id like '([^%']*)%'", add)
+
+class RecordedStore:
+    # Serve a nightlogs/<tel>/P<period>/<night> tree
+    def __init__(self, root):
+        self.root = root
+    def night_dirs(self, night):
+        pattern = os.path.join(self.root, '*', 'P*', night)
+        return sorted(glob.glob(pattern))
+    def get_listing(self, night, inslist=None):
+        for path in self.night_dirs(night):
+            filename = os.path.join(path, night + '.xml')
+            if os.path.exists(filename):
+                with open(filename, 'rb') as fh:
+                    return fh.read()
+        return votable([])
+    def get_header(self, dataid):
+        # Frames are stored under their night, i.e. UT date or day before
+        m = re.search('([0-9]{4}-[0-9]{2}-[0-9]{2})T', dataid)
+        if m is None:
+            return None
+        date = datetime.date(*[int(x) for x in m.group(1).split('-')])
+        for day in [date, date - datetime.timedelta(days=1)]:
+            night = day.isoformat()
+            for path in self.night_dirs(night):
+                pack = HeaderPack.open(os.path.join(path, night + PACK_EXT))
+                text = pack.get(dataid)
+                if text is not None:
+                    return text
+                filename = os.path.join(path, dataid + '.fits.hdr')
+                if os.path.exists(filename):
+                    return read_header_textfile(filename)
+        return None
+
+class SyntheticStore:
+    # Generate nights of OBs with plausible ESO keywords
+    instruments = ['FEROS', 'WFI', 'GROND']
+    def __init__(self, nframes=500, nexp=5, exptime=60., overhead=30.,
+            pid='0104.A-9001(A)', seed=1):
+        self.nframes = nframes
+        self.nexp = nexp
+        self.exptime = exptime
+        self.overhead = overhead
+        self.pid = pid
+        self.seed = seed
+        self.headers = {}
+        self.lock = threading.Lock()
+    def make_night(self, night, inslist=None):
+        inslist = inslist or self.instruments
+        rng = random.Random('{}-{}'.format(self.seed, night))
+        day = datetime.datetime.strptime(night, '%Y-%m-%d')
+        t = day + datetime.timedelta(hours=23, minutes=30)
+        rows, headers = [], {}
+        i = 0
+        while i < self.nframes:
+            ins = rng.choice(inslist)
+            nexp = min(self.nexp, self.nframes - i)
+            obstart = t
+            target = 'TARGET-{:03}'.format(rng.randint(1, 99))
+            t += datetime.timedelta(seconds=120)
+            tplstart = t
+            for expno in range(1, nexp + 1):
+                dateobs = t.isoformat(timespec='milliseconds')
+                dataid = '{}.{}'.format(ins, dateobs)
+                cards = [('SIMPLE', True), ('DATE-OBS', dateobs),
+                    ('EXPTIME', self.exptime), ('INSTRUME', ins),
+                    ('OBJECT', target), ('RA', rng.uniform(0, 360)),
+                    ('DEC', rng.uniform(-90, 30)),
+                    ('HIERARCH ESO OBS START', obstart.isoformat()[0:19]),
+                    ('HIERARCH ESO OBS NAME', 'OB-' + target),
+                    ('HIERARCH ESO OBS PROG ID', self.pid),
+                    ('HIERARCH ESO OBS TARG NAME', target),
+                    ('HIERARCH ESO TPL START', tplstart.isoformat()[0:19]),
+                    ('HIERARCH ESO TPL NEXP', nexp),
+                    ('HIERARCH ESO TPL EXPNO', expno),
+                    ('HIERARCH ESO DPR CATG', 'SCIENCE'),
+                    ('HIERARCH ESO DPR TYPE', 'OBJECT'),
+                    ('HIERARCH ESO DPR TECH', 'IMAGE'),
+                    ('HIERARCH ESO TEL TRAK STATUS', 'NORMAL'),
+                    ('HIERARCH ESO TEL GEOLON', -70.7346),
+                    ('HIERARCH ESO TEL GEOLAT', -29.2543),
+                    ('HIERARCH ESO TEL GEOELEV', 2335.)]
+                headers[dataid] = format_cards(cards)
+                rows.append((dataid, self.exptime, ins))
+                t += datetime.timedelta(seconds=self.exptime + self.overhead)
+                i += 1
+        with self.lock:
+            self.headers.update(headers)
+        return rows
+    def get_listing(self, night, inslist=None):
+        return votable(self.make_night(night, inslist=inslist))
+    def get_header(self, dataid):
+        with self.lock:
+            if dataid in self.headers:
+                return self.headers[dataid]
+        m = re.search('([0-9]{4}-[0-9]{2}-[0-9]{2})T([0-9]{2})', dataid)
+        if m is None:
+            return None
+        # Header asked before the listing: generate its night
+        date = datetime.datetime.strptime(m.group(1), '%Y-%m-%d')
+        if int(m.group(2)) < 12:
+            date -= datetime.timedelta(days=1)
+        self.make_night(date.strftime('%Y-%m-%d'))
+        with self.lock:
+            return self.headers.get(dataid)
+
+def format_cards(cards):
+    lines = []
+    for key, value in cards:
+        if isinstance(value, bool):
+            value = 'T' if value else 'F'
+            value = '{:>20}'.format(value)
+        elif isinstance(value, str):
+            value = "'{:<8}'".format(value.replace("'", "''"))
+        else:
+            value = '{:>20}'.format(repr(value))
+        if key[0:9] == 'HIERARCH ':
+            card = '{} = {}'.format(key, value)
+        else:
+            card = '{:<8}= {}'.format(key, value)
+        lines.append(card[0:80].ljust(80))
+    lines.append('END'.ljust(80))
+    text = ''.join(lines)
+    return text + ' ' * (-len(text) % 2880)
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def log_message(self, format, *arg):
+        pass
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        self.serve(parts.path, urllib.parse.parse_qs(parts.query))
+    def do_POST(self):
+        parts = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        form = urllib.parse.parse_qs(parts.query)
+        form.update(urllib.parse.parse_qs(body))
+        self.serve(parts.path, form)
+    def serve(self, path, form):
+        server = self.server
+        server.count(path)
+        if server.latency > 0:
+            time.sleep(server.latency * server.rng_uniform(0.5, 1.5))
+        if server.rng_uniform(0, 1) < server.error_rate:
+            server.count('errors')
+            self.reply(503, b'Service temporarily unavailable')
+            return
+        if path == QUERY_PATH:
+            night = query_night(form)
+            data = server.store.get_listing(night, query_instruments(form))
+            self.reply(200, data, 'application/x-votable+xml')
+        elif path == HEADER_PATH:
+            dataid = form.get('DpId', [''])[0]
+            text = server.store.get_header(dataid)
+            if text is None:
+                self.reply(404, b'No such dataset')
+            else:
+                self.reply(200, header_page(text), 'text/html')
+        else:
+            self.reply(404, b'Not found')
+    def reply(self, status, data, ctype='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ArchiveStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, store, latency=0., error_rate=0., port=0, seed=None):
+        super().__init__(('127.0.0.1', port), ArchiveHandler)
+        self.store = store
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.thread = None
+    @property
+    def mirror(self):
+        host, port = self.server_address[0:2]
+        return 'http://{}:{}'.format(host, port)
+    def rng_uniform(self, a, b):
+        with self.lock:
+            return self.rng.uniform(a, b)
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+    def __enter__(self):
+        return self.start()
+    def __exit__(self, *arg):
+        self.stop()
+
+def benchmark(nights, tel='2.2m', path='.', store=None, latency=0.,
+        error_rate=0., jobs=1, seed=None):
+    # Time NightLog.generate against the stand-in.  The logs are written
+    # under path, which must hold the programme lists of the periods.
+    from MPG.esolog import NightLog
+    if store is None:
+        store = SyntheticStore()
+    timings = []
+    with ArchiveStandIn(store, latency=latency, error_rate=error_rate,
+                        seed=seed) as server:
+        for night in nights:
+            t0 = time.time()
+            log = NightLog.generate(tel, night=night, path=path, jobs=jobs,
+                    mirror=server.mirror, clobberHeaderList=True,
+                    clobberHeader=True)
+            dt = time.time() - t0
+            timings.append((night, len(log), dt))
+            print('{}: {} rows in {:.2f} s'.format(night, len(log), dt))
+        print('requests:', server.counters)
+    return timings
+
+if __name__ == "__main__":
+    from MPG.utils import argparser
+    parser = argparser(description='Offline ESO archive stand-in')
+    parser.add_argument('night', nargs='*', help='Nights to generate')
+    parser.add_argument('--fixtures', default=None,
+        help='Recorded nightlogs tree (synthetic nights if not given)')
+    parser.add_argument('--frames', type=int, default=500,
+        help='Number of frames of synthetic nights')
+    parser.add_argument('--latency', type=float, default=0.,
+        help='Mean response latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.,
+        help='Fraction of requests answered with HTTP 503')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Number of concurrent FITS header downloads')
+    parser.add_argument('--port', type=int, default=0,
+        help='Only serve on this port (no benchmark)')
+    arg = parser.parse_args()
+    if arg.fixtures is not None:
+        store = RecordedStore(arg.fixtures)
+    else:
+        store = SyntheticStore(nframes=arg.frames)
+    if arg.port:
+        server = ArchiveStandIn(store, latency=arg.latency,
+                    error_rate=arg.error_rate, port=arg.port)
+        print('serving on', server.mirror)
+        server.serve_forever()
+    else:
+        benchmark(arg.night, tel=arg.tel, path=arg.dir, store=store,
+            latency=arg.latency, error_rate=arg.error_rate, jobs=arg.jobs)
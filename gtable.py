@@ -3,7 +3,7 @@ from html import escape, unescape
 
 import sys
 import os
-from numpy import argwhere, size, array, zeros, cumsum
+from numpy import argwhere, size, array, zeros, cumsum, argsort, searchsorted
 from astropy import table
 from astropy.io import ascii, registry 
 from astropy.io.ascii import html, fixedwidth, core
@@ -325,6 +325,26 @@ class HTMLWithGroups(html.HTML):
         return table
 
 
+class SortedIndex:
+    # Rows of a column by value, O(log n) through binary search.  It is 
+    # only valid for the column object and column version (see
+    # Table.column_version) it was built on.
+    def __init__(self, col, version=0):
+        self.column = col
+        self.version = version
+        self.order = argsort(array(col), kind='stable')
+        self.values = array(col)[self.order]
+    def is_valid(self, col, version=0):
+        return (col is self.column and len(col) == len(self.order)
+                    and version == self.version)
+    def find(self, value):
+        # Row numbers (ascending) with column == value
+        i1 = searchsorted(self.values, value, side='left')
+        i2 = searchsorted(self.values, value, side='right')
+        return self.order[i1:i2]
+    def __contains__(self, value):
+        return len(self.find(value)) > 0
+
 class Table(table.Table):
     def write(self, output=None, *arg, fast_writer=True, 
             format='ascii.ascii_with_groups', repeat_header=True, 
@@ -377,10 +397,58 @@ class Table(table.Table):
         if a[0] == '_' or a in self.__dict__ or a in ['columns', 'formatter', 'meta']:
             super().__setattr__(a, v)
         elif a in self._get_colnames():
-            super().__setitem__(a, v)
+            self[a] = v
         else:
             meta = self._get_meta()
             meta[a] = v
+    def column_version(self, name):
+        return self.__dict__.get('_versions', {}).get(name, 0)
+    def bump_versions(self, names=None):
+        # Count changes of columns (all of them by default)
+        versions = self.__dict__.setdefault('_versions', {})
+        for name in self.colnames if names is None else names:
+            versions[name] = versions.get(name, 0) + 1
+    def get_index(self, name):
+        # Sorted index on a column, rebuilt when the column was replaced
+        # or its version changed (column or row assignments, inserts,
+        # sorts).  In-place edits of column elements, e.g. 
+        # log['night'][mask] = ..., must call invalidate_indexes.
+        indexes = self.__dict__.setdefault('_sorted_indexes', {})
+        col = self.columns[name]
+        version = self.column_version(name)
+        if name not in indexes or not indexes[name].is_valid(col, version):
+            indexes[name] = SortedIndex(col, version)
+        return indexes[name]
+    def invalidate_indexes(self):
+        self.__dict__.pop('_sorted_indexes', None)
+    def query(self, name, value):
+        # Row numbers where column name equals value
+        return self.get_index(name).find(value)
+    def __setitem__(self, item, value):
+        if isinstance(item, str) and item in self.colnames:
+            self.bump_versions([item])
+        else:
+            self.bump_versions()
+        super().__setitem__(item, value)
+    def _replace_cols(self, columns):
+        self.bump_versions()
+        super()._replace_cols(columns)
+    def insert_row(self, index, vals=None, mask=None):
+        # Also used by add_row
+        self.bump_versions()
+        super().insert_row(index, vals=vals, mask=mask)
+    def sort(self, *arg, **kwarg):
+        self.bump_versions()
+        super().sort(*arg, **kwarg)
+    def extend(self, rows):
+        # Append the rows of a table with the same columns in one step
+        # (add_row reallocates every column for each row)
+        if len(rows) == 0:
+            return
+        n = len(self)
+        columns = [col.insert(n, rows[name], axis=0) 
+                    for name, col in self.columns.items()]
+        self._replace_cols(table.TableColumns(columns))
     def group_by(self, keys, sort_by_keys=True):
         if keys == []:
             tab = self.copy()
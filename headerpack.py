@@ -0,0 +1,199 @@
+import os
+import re
+import mmap
+import threading
+
+# Per-night container of FITS headers.  The blobs (80-column cards padded
+# to 2880 bytes) are appended to a single data file and a text index
+# gives their location:
+#
+#   <night>-headers.pack   concatenated header blobs
+#   <night>-headers.idx    one "dp_id offset length" line per blob
+#
+# The data file is read through mmap.  A blob is written before its index
+# line, so an interrupted append leaves at worst an unindexed tail.  When a
+# dp_id is appended twice (e.g. clobbered header) the last entry wins and
+# the older blob is garbage until the pack is compacted: live blobs are
+# copied to new files that replace the pack, then the index.  A leftover
+# new index without a new pack is the end of an interrupted compaction.
+
+PACK_EXT = '-headers.pack'
+INDEX_EXT = '-headers.idx'
+
+def format_header_text(lines):
+    # Cards as 80-column records padded to a FITS block
+    h = ''.join(l[0:80] + ' ' * (80 - len(l[0:80])) for l in lines)
+    h += ' ' * (2880 - (len(h) % 2880))
+    return h
+
+def read_header_textfile(filename):
+    with open(filename, 'r') as fh:
+        return format_header_text(fh.read().splitlines())
+
+class HeaderPack:
+    _open_packs = {}
+    _open_lock = threading.Lock()
+    @classmethod
+    def open(cls, filename):
+        # Packs are shared between the threads fetching a night
+        filename = os.path.abspath(filename)
+        with cls._open_lock:
+            if filename not in cls._open_packs:
+                cls._open_packs[filename] = cls(filename)
+            return cls._open_packs[filename]
+    def __init__(self, filename):
+        base = filename[:-len(PACK_EXT)] if filename.endswith(PACK_EXT) \
+                else filename
+        self.filename = base + PACK_EXT
+        self.indexname = base + INDEX_EXT
+        self.lock = threading.Lock()
+        self.index = None
+        self.map = None
+        self.mapsize = 0
+        self.nentries = 0
+    def load_index(self):
+        index = {}
+        nentries = 0
+        if os.path.exists(self.indexname + '.tmp'):
+            if os.path.exists(self.filename + '.tmp'):
+                os.remove(self.filename + '.tmp')
+                os.remove(self.indexname + '.tmp')
+            else:
+                os.replace(self.indexname + '.tmp', self.indexname)
+        try:
+            size = os.path.getsize(self.filename)
+            with open(self.indexname, 'r') as fh:
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) != 3:
+                        continue
+                    dataid, offset, length = fields
+                    offset, length = int(offset), int(length)
+                    if offset + length <= size:
+                        index[dataid] = (offset, length)
+                        nentries += 1
+        except (OSError, ValueError):
+            pass
+        self.index = index
+        self.nentries = nentries
+    def _ensure_index(self):
+        if self.index is None:
+            self.load_index()
+    def __contains__(self, dataid):
+        with self.lock:
+            self._ensure_index()
+            return dataid in self.index
+    def __len__(self):
+        with self.lock:
+            self._ensure_index()
+            return len(self.index)
+    def keys(self):
+        with self.lock:
+            self._ensure_index()
+            return list(self.index.keys())
+    def _remap(self, size):
+        if self.map is not None:
+            self.map.close()
+        with open(self.filename, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mapsize = size
+    def get(self, dataid):
+        with self.lock:
+            self._ensure_index()
+            if dataid not in self.index:
+                return None
+            offset, length = self.index[dataid]
+            if offset + length > self.mapsize:
+                self._remap(os.path.getsize(self.filename))
+            return self.map[offset:offset + length].decode('ascii')
+    def append(self, dataid, text):
+        blob = text.encode('ascii', errors='replace')
+        with self.lock:
+            self._ensure_index()
+            with open(self.filename, 'ab') as fh:
+                offset = fh.tell()
+                fh.write(blob)
+            with open(self.indexname, 'a') as fh:
+                fh.write('{} {} {}\n'.format(dataid, offset, len(blob)))
+            self.index[dataid] = (offset, len(blob))
+            self.nentries += 1
+    def garbage(self):
+        # Number of superseded blobs
+        with self.lock:
+            self._ensure_index()
+            return self.nentries - len(self.index)
+    def compact(self):
+        # Rewrite the pack with the live blobs only
+        with self.lock:
+            self._ensure_index()
+            if self.nentries == len(self.index):
+                return 0
+            index, offset = {}, 0
+            with open(self.filename, 'rb') as src, \
+                 open(self.filename + '.tmp', 'wb') as dst:
+                for dataid, (start, length) in sorted(self.index.items(), 
+                        key=lambda item: item[1][0]):
+                    src.seek(start)
+                    dst.write(src.read(length))
+                    index[dataid] = (offset, length)
+                    offset += length
+            with open(self.indexname + '.tmp', 'w') as fh:
+                for dataid, (start, length) in index.items():
+                    fh.write('{} {} {}\n'.format(dataid, start, length))
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                self.mapsize = 0
+            os.replace(self.filename + '.tmp', self.filename)
+            os.replace(self.indexname + '.tmp', self.indexname)
+            ngarbage = self.nentries - len(index)
+            self.index = index
+            self.nentries = len(index)
+            return ngarbage
+    def forget(self):
+        # Pack no longer used (night done) or removed from disk (cache
+        # eviction); it is opened again on next use
+        with HeaderPack._open_lock:
+            HeaderPack._open_packs.pop(os.path.abspath(self.filename), None)
+        self.close()
+        with self.lock:
+            self.index = None
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                self.mapsize = 0
+
+def migrate_night(path, remove=False, verbose=1):
+    # Move the legacy <dp_id>.fits.hdr files of a night directory into
+    # the night's pack.  Headers already packed are left untouched.
+    night = os.path.basename(os.path.normpath(path))
+    pack = HeaderPack.open(os.path.join(path, night + PACK_EXT))
+    filenames = sorted(f for f in os.listdir(path) if f.endswith('.fits.hdr'))
+    nnew = 0
+    for f in filenames:
+        dataid = f[:-len('.fits.hdr')]
+        filename = os.path.join(path, f)
+        if dataid not in pack:
+            pack.append(dataid, read_header_textfile(filename))
+            nnew += 1
+        if remove:
+            os.remove(filename)
+    if verbose > 0 and len(filenames):
+        print('{}: packed {} of {} headers'.format(night, nnew, len(filenames)))
+    ngarbage = pack.compact()
+    if verbose > 0 and ngarbage:
+        print('{}: dropped {} superseded headers'.format(night, ngarbage))
+    pack.close()
+    return nnew
+
+def migrate_tree(path, remove=False, verbose=1):
+    # Walk nightlogs/<tel>/P<period>/<night> directories
+    nnew = 0
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        night = os.path.basename(root)
+        if re.match('^[0-9]{4}-[0-9]{2}-[0-9]{2}$', night):
+            nnew += migrate_night(root, remove=remove, verbose=verbose)
+    return nnew
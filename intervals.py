@@ -0,0 +1,87 @@
+import numpy
+
+# Sets of time intervals (night, twilight, dark time...) stored as sorted,
+# disjoint, half-open [start, end) datetime64 intervals.  Membership and
+# overlap queries use searchsorted on the bounds and a cumulative measure,
+# so clipping n observations to m intervals is O((n + m) log m).
+
+HOUR = numpy.timedelta64(3600, 's')
+
+def as_datetime64(t):
+    t = numpy.asarray(t)
+    if t.dtype.kind == 'O':
+        t = t.astype(str)
+    return t.astype('datetime64[us]')
+
+class IntervalSet:
+    def __init__(self, intervals=[]):
+        # intervals: list of (start, end) ISO dates or datetime64
+        bounds = numpy.reshape(as_datetime64(intervals), (-1, 2))
+        self._set_bounds(bounds[:,0], bounds[:,1])
+    @classmethod
+    def from_arrays(cls, start, end):
+        iset = cls()
+        iset._set_bounds(as_datetime64(start), as_datetime64(end))
+        return iset
+    def _set_bounds(self, start, end):
+        # Sort and merge overlapping intervals, drop empty ones (or NaT)
+        keep = end > start
+        start, end = start[keep], end[keep]
+        order = numpy.argsort(start, kind='stable')
+        start, end = start[order], end[order]
+        if len(start):
+            end = numpy.maximum.accumulate(end)
+            first = numpy.ones(len(start), dtype=bool)
+            first[1:] = start[1:] > end[:-1]
+            last = numpy.append(first[1:], True)
+            start, end = start[first], end[last]
+        self.start, self.end = start, end
+        self.cumul = numpy.cumsum((end - start) / HOUR)
+    def __len__(self):
+        return len(self.start)
+    def __iter__(self):
+        start = numpy.datetime_as_string(self.start, unit='s')
+        end = numpy.datetime_as_string(self.end, unit='s')
+        return zip(start.tolist(), end.tolist())
+    def __repr__(self):
+        return 'IntervalSet({})'.format(list(self))
+    def measure(self):
+        # Total duration in hours
+        return float(self.cumul[-1]) if len(self) else 0.
+    def measure_before(self, t):
+        # Hours of the set before t
+        t = as_datetime64(t)
+        if not len(self):
+            return numpy.zeros(numpy.shape(t))
+        k = numpy.searchsorted(self.start, t, side='right') - 1
+        i = numpy.maximum(k, 0)
+        dt = self.cumul[i] - numpy.maximum((self.end[i] - t) / HOUR, 0)
+        return numpy.where(k >= 0, dt, 0.)
+    def overlap(self, start, end):
+        # Hours of each [start, end) within the set
+        dt = self.measure_before(end) - self.measure_before(start)
+        return numpy.maximum(dt, 0)
+    def contains(self, t):
+        t = as_datetime64(t)
+        if not len(self):
+            return numpy.zeros(numpy.shape(t), dtype=bool)
+        k = numpy.searchsorted(self.start, t, side='right') - 1
+        return (k >= 0) * (t < self.end[numpy.maximum(k, 0)])
+    def _combine(self, other, op):
+        # Apply op to the membership of the elementary segments bounded
+        # by all interval bounds
+        bounds = numpy.unique(numpy.hstack([self.start, self.end,
+                    other.start, other.end]))
+        if not len(bounds):
+            return IntervalSet()
+        inside = op(self.contains(bounds[:-1]), other.contains(bounds[:-1]))
+        return IntervalSet.from_arrays(bounds[:-1][inside], bounds[1:][inside])
+    def union(self, other):
+        return self._combine(other, numpy.logical_or)
+    def intersection(self, other):
+        return self._combine(other, numpy.logical_and)
+    def difference(self, other):
+        return self._combine(other, lambda a, b: a * ~b)
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
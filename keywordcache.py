@@ -0,0 +1,85 @@
+import os
+import hashlib
+import numpy
+
+# Columnar cache of the keyword values extracted from the FITS headers of
+# a night (one row per dp_id, one column per esolog.dat keyword).  It is
+# stored as <night>-keywords.npz and is only valid for the keyword table
+# it was built with: the table hash is stored along the columns and a
+# cache with a different hash is ignored.
+
+CACHE_EXT = '-keywords.npz'
+
+def keyword_table_hash(keywords):
+    sha = hashlib.sha1()
+    for row in keywords:
+        fields = [row[c] for c in ['name', 'type', 'width', 'default',
+                                   'fits_keys']]
+        sha.update(repr([str(f) for f in fields]).encode('utf-8'))
+    return sha.hexdigest()
+
+class KeywordCache:
+    def __init__(self, filename, names, types, key):
+        self.filename = filename
+        self.names = list(names)
+        self.types = list(types)
+        self.key = key
+        self.dataids = []
+        self.columns = [[] for n in self.names]
+        self.rownum = {}
+        self.modified = False
+    def load(self):
+        try:
+            with numpy.load(self.filename) as data:
+                if str(data['hash']) != self.key:
+                    return self
+                dataids = data['dp_id'].tolist()
+                columns = [data['k_' + n].tolist() for n in self.names]
+        except (OSError, KeyError, ValueError):
+            return self
+        self.dataids = dataids
+        self.columns = columns
+        self.rownum = {d: i for i, d in enumerate(dataids)}
+        return self
+    def clear(self):
+        self.dataids = []
+        self.columns = [[] for n in self.names]
+        self.rownum = {}
+        self.modified = True
+    def __contains__(self, dataid):
+        return decode(dataid) in self.rownum
+    def missing(self, dataids):
+        return [d for d in dataids if decode(d) not in self.rownum]
+    def update(self, dataids, rows):
+        for dataid, row in zip(dataids, rows):
+            dataid = decode(dataid)
+            if dataid in self.rownum:
+                i = self.rownum[dataid]
+                for col, value in zip(self.columns, row):
+                    col[i] = value
+            else:
+                self.rownum[dataid] = len(self.dataids)
+                self.dataids.append(dataid)
+                for col, value in zip(self.columns, row):
+                    col.append(value)
+            self.modified = True
+    def get_columns(self, dataids):
+        index = [self.rownum[decode(d)] for d in dataids]
+        return [numpy.array([col[i] for i in index], dtype=t)
+                    for col, t in zip(self.columns, self.types)]
+    def save(self):
+        if not self.modified:
+            return
+        cols = {'k_' + n: numpy.array(c, dtype=t)
+                    for n, c, t in zip(self.names, self.columns, self.types)}
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'wb') as fh:
+            numpy.savez(fh, hash=numpy.array(self.key),
+                    dp_id=numpy.array(self.dataids, dtype=str), **cols)
+        os.replace(tmpname, self.filename)
+        self.modified = False
+
+def decode(dataid):
+    if isinstance(dataid, bytes):
+        return dataid.decode()
+    return str(dataid)
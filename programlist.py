@@ -41,6 +41,9 @@ class ProgramList(numpy.ndarray):
         if isinstance(i, str) and i in self.dtype.names:
             item = numpy.array(item.tolist())
         return item
+    def has_corrections(self, pid):
+        # Whether the lookup of pid depends on target and date
+        return any(line['PID'] in pid for line in self.corr)
     def lookup(self, pid, target=None, date=None, ins=None):
         # print('lookup', pid, ins)
         if target is not None or date is not None:
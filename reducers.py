@@ -0,0 +1,88 @@
+import numpy
+
+# Vectorised reductions of a column over groups of consecutive rows.  The
+# groups are given by their boundaries (as astropy's groups.indices) and
+# each reducer returns one value per group, using reduceat or a single
+# sort of the column within groups.  Joining reducers also work on the
+# integer codes of dictionary-encoded columns, given the sorted labels of
+# the codes: only the distinct codes of each group are decoded.
+
+class Segments:
+    def __init__(self, indices):
+        indices = numpy.asarray(indices)
+        self.first = indices[:-1]
+        self.counts = numpy.diff(indices)
+        self.last = indices[1:] - 1
+        self.group = numpy.repeat(numpy.arange(len(self.counts)), self.counts)
+    def __len__(self):
+        return len(self.counts)
+    def sort(self, values):
+        # Order sorting values within each group
+        return numpy.lexsort((values, self.group))
+    def broadcast(self, values):
+        return values[self.group]
+
+def reduce_min(values, seg):
+    return values[seg.sort(values)[seg.first]]
+
+def reduce_max(values, seg):
+    return values[seg.sort(values)[seg.last]]
+
+def reduce_sum(values, seg):
+    if values.dtype == bool:
+        values = values.astype(int)
+    return numpy.add.reduceat(values, seg.first)
+
+def reduce_mean(values, seg):
+    return reduce_sum(values, seg) / seg.counts
+
+def reduce_unique(values, seg, fill):
+    # Common value of the group, or fill if values differ
+    first = values[seg.first]
+    same = numpy.logical_and.reduceat(values == seg.broadcast(first),
+                seg.first)
+    return numpy.where(same, first, fill)
+
+def reduce_concat(values, seg, sep=',', labels=None):
+    # Distinct values of the group, sorted and joined
+    values = values[seg.sort(values)]
+    keep = numpy.ones(len(values), dtype=bool)
+    keep[1:] = (values[1:] != values[:-1]) + (seg.group[1:] != seg.group[:-1])
+    cuts = numpy.cumsum(reduce_sum(keep, seg))[:-1]
+    values = values[keep] if labels is None else labels[values[keep]]
+    parts = numpy.split(values.astype(str), cuts)
+    return numpy.array([sep.join(p) for p in parts])
+
+def reduce_majority(values, seg, choices, fraction=0.49, sep=',', 
+        labels=None):
+    # First choice present in more than fraction of the group, or the
+    # distinct values joined
+    result = reduce_concat(values, seg, sep=sep, labels=labels).astype(object)
+    done = numpy.zeros(len(seg), dtype=bool)
+    for choice in choices:
+        if labels is None:
+            count = reduce_sum(values == choice, seg)
+        else:
+            count = reduce_sum(values == encode(labels, choice), seg)
+        major = ~done * (count > fraction * seg.counts)
+        result[major] = choice
+        done += major
+    return result.astype(str)
+
+REDUCERS = {
+    'min': reduce_min,
+    'max': reduce_max,
+    'sum': reduce_sum,
+    'mean': reduce_mean,
+    'unique': reduce_unique,
+    'concat': reduce_concat,
+    'majority': reduce_majority,
+}
+
+def encode(labels, value):
+    # Code of value in sorted labels (-1 if absent)
+    i = numpy.searchsorted(labels, value)
+    return i if i < len(labels) and labels[i] == value else -1
+
+def reduce(values, seg, how, *arg, **kwarg):
+    return REDUCERS[how](numpy.asarray(values), seg, *arg, **kwarg)
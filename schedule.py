@@ -4,17 +4,16 @@
 from openpyxl import load_workbook as open_xlsx
 from openpyxl.cell import Cell as XlsxCell
 from cgi import escape
-from urllib.request import urlopen
-from shutil import copyfileobj
 
 import numpy as np
 import os
 import re
 import datetime
 
-from MPG.utils import get_sun, get_period_limits, iter_period_dates, load_config
+from MPG.utils import get_period_limits, iter_period_dates, load_config
+from MPG.ephemeris import PeriodEphemeris
 from MPG.esolog import BasicLog
-from MPG.esoarchive import NightRequest
+from MPG.esoarchive import NightRequest, get_client
 from MPG.programlist import ProgramList
 
 def get_shift_name(tel, period, path='.'):
@@ -133,7 +132,11 @@ def parse_xlsx_schedule(tel, period, path='.'):
     progs = [merge_cells(row, config, night_length=night_length) 
                     for row in progs] 
     dates = [date for date in iter_period_dates(period)]
-    ephem = [get_sun(date) for date in dates]
+    # Table shared with the night logs
+    logpath = BasicLog(tel=tel, period=period, path=path).get_path(
+                level='base')
+    table = PeriodEphemeris.get(tel, period, path=logpath)
+    ephem = table.sun_events([str(date) for date in dates])
     return dates, ephem, obs, sa, progs
 
 def write_html_shifts(data, tel, period, path='.'):
@@ -401,8 +404,9 @@ def retrieve_xls_schedule(tel, period, path='.'):
     if path.lower() != 'none':
         locname = get_schedule_name(tel, period, format=fmt, path=path)
         url = 'http://{}/{}'.format(hostname, urlpath, period, fmt)
-        with urlopen(url) as response, open(locname, 'wb') as out:
-            copyfileobj(response, out)
+        data = get_client().get(url)
+        with open(locname, 'wb') as out:
+            out.write(data)
         if fmt != 'xls':
            xls = get_schedule_name(tel, period, format='xls', path=path)
            cmd = '/usr/bin/ssconvert -T Gnumeric_Excel:excel_dsf'
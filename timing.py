@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Timing spans for the log pipeline.  Spans nest (per thread) and spans
+# of the same name under the same parent are merged, with a call count.
+# Nothing is recorded unless the profiler is enabled (mpglogs --profile).
+#
+#   with span('fill_gaps'):
+#       with span('insert_gap'):
+#           ...
+#
+# A span given a filename (.json) writes its subtree on exit to it and,
+# in the folded format of flame graph tools, to the same name with the 
+# .folded extension.
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.time = 0.
+        self.calls = 0
+        self.children = {}
+    def child(self, name):
+        if name not in self.children:
+            self.children[name] = Span(name)
+        return self.children[name]
+    def as_dict(self):
+        return {'name': self.name, 'time': round(self.time, 6),
+                'calls': self.calls,
+                'children': [c.as_dict() for c in self.children.values()]}
+    def folded(self, prefix=''):
+        # stack;of;spans self-time (microseconds)
+        stack = prefix + self.name
+        own = self.time - sum(c.time for c in self.children.values())
+        lines = ['{} {}'.format(stack, int(max(own, 0) * 1e6))]
+        for c in self.children.values():
+            lines += c.folded(prefix=stack + ';')
+        return lines
+    def report(self, indent=0):
+        lines = ['{}{:<{}} {:9.3f} s {:5d}'.format(' ' * indent, self.name,
+            40 - indent, self.time, self.calls)]
+        for c in self.children.values():
+            lines += c.report(indent=indent + 2)
+        return lines
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.root = Span('all')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+    def enable(self, enabled=True):
+        self.enabled = enabled
+    def reset(self):
+        self.root = Span('all')
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = [self.root]
+        return self.local.stack
+    @contextmanager
+    def span(self, name, filename=None):
+        if not self.enabled:
+            yield None
+            return
+        stack = self._stack()
+        with self.lock:
+            node = stack[-1].child(name)
+        stack.append(node)
+        t0 = time.perf_counter()
+        try:
+            yield node
+        finally:
+            dt = time.perf_counter() - t0
+            stack.pop()
+            with self.lock:
+                node.time += dt
+                node.calls += 1
+            if filename is not None:
+                self.dump(node, filename)
+    def dump(self, node, filename):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename, 'w') as fh:
+            json.dump(node.as_dict(), fh, indent=1)
+        with open(os.path.splitext(filename)[0] + '.folded', 'w') as fh:
+            fh.write('\n'.join(node.folded()) + '\n')
+    def report(self):
+        return '\n'.join(line for c in self.root.children.values()
+                            for line in c.report())
+
+profiler = Profiler()
+
+def span(name, filename=None):
+    return profiler.span(name, filename=filename)
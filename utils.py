@@ -1,4 +1,3 @@
-import ephem
 import datetime
 import configparser
 import numpy
@@ -23,32 +22,6 @@ def argparser(description, wwwsubdir=''):
 
     return parser
 
-def get_sun(date, twilight='astronomical'):
-    obs = ephem.Observer()
-    obs.date = date
-    obs.lon = '-70.729166667'
-    obs.lat = '-29.256666666'
-    obs.date += 1 - float(obs.lon) / 360
-    #obs.elev = 2347.
-    obs.horizon = '-02:00' # 18 * pi / 180
-    obs.pressure = 0 # 760
-    obs.temp = 15
-    sun = ephem.Sun()
-    sun.compute(obs)
-    srise = obs.next_rising(sun).datetime()
-    sset = obs.previous_setting(sun).datetime()
-    obs.pressure = 0
-    if twilight == 'astronomical':
-      obs.horizon = '-18:00' # * pi / 180
-    elif twilight == 'nautical':
-      obs.horizon = '-12:00'
-    else:
-      obs.horizon = '-06:00'
-    twend =  obs.previous_setting(sun, use_center=True).datetime()
-    twbegin = obs.next_rising(sun, use_center=True).datetime()
-    return (sset, twend, twbegin, srise)
-
-
 def load_config(tel, period, path='.'):
     from MPG.esolog import BasicLog
     path = BasicLog(tel=tel, period=period, path=path).get_path()